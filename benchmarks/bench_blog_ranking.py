@@ -0,0 +1,93 @@
+"""Top-N blogs by subscribers: popularity index vs. scanning and sorting every blog.
+
+Seeds BlogBlog (moto) with --blogs blogs whose subscriber counts follow a long
+tail, then fetches the top --top blogs through the blog lambda's
+get_popular_blogs and the old way (full scan, sort in memory). Reports items
+and estimated read units each approach has to read:
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_blog_ranking.py --blogs 100000 --top 10
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+
+import boto3
+from moto import mock_aws
+
+from support import REGION, ReadCounter, create_tables, load_handler
+
+from common.blogs import popularity_shard
+
+
+def seed(table, count, rng):
+    with table.batch_writer() as batch:
+        for _ in range(count):
+            blog_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            subscribers = min(int(rng.paretovariate(1.2)) - 1, 1000)
+            batch.put_item(Item={
+                'Id': blog_id,
+                'author': str(uuid.UUID(int=rng.getrandbits(128))),
+                'title': f'blog {blog_id[:8]}',
+                'category': rng.choice(['tech', 'food', 'travel', 'music']),
+                'description': 'benchmark blog',
+                'subscribers': [f'{i:036d}' for i in range(subscribers)],
+                'subscriber_count': subscribers,
+                'popularity_shard': popularity_shard(blog_id),
+            })
+
+
+def scan_and_sort(table, top):
+    blogs = []
+    kwargs = {}
+    while True:
+        page = table.scan(**kwargs)
+        blogs.extend(page['Items'])
+        if 'LastEvaluatedKey' not in page:
+            break
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+    return sorted(blogs, key=lambda blog: len(blog['subscribers']), reverse=True)[:top]
+
+
+def measure(counter, fn):
+    counter.reset()
+    start = time.perf_counter()
+    result = fn()
+    return result, {
+        'items_read': counter.scanned,
+        'requests': counter.calls,
+        'read_units': counter.read_units,
+        'emulator_ms': round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
+def run(blogs, top, seed_value):
+    with mock_aws():
+        create_tables()
+        table = boto3.resource('dynamodb', region_name=REGION).Table('BlogBlog')
+        seed(table, blogs, random.Random(seed_value))
+        blog_app = load_handler('blog')
+        counter = ReadCounter(blog_app.blog_blog_table.meta.client)
+
+        (ranked, _), index = measure(counter, lambda: blog_app.get_popular_blogs(top, None))
+        scanned, scan = measure(counter, lambda: scan_and_sort(blog_app.blog_blog_table, top))
+        assert [blog['subscriber_count'] for blog in ranked] == [blog['subscriber_count'] for blog in scanned]
+
+        result = {'blogs': blogs, 'top': top, 'index': index, 'scan_and_sort': scan}
+        print(json.dumps(result))
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--blogs', type=int, default=100000)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=305)
+    args = parser.parse_args()
+    run(args.blogs, args.top, args.seed)
+
+
+if __name__ == '__main__':
+    main()
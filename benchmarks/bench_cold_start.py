@@ -0,0 +1,85 @@
+"""Cold start: import and client setup time of every lambda in a fresh interpreter.
+
+Each function's app.py is imported in a new Python process, --runs times, and
+timed up to the point where every table and client it holds is ready to send
+a request. With --baseline the same is measured for the lambdas at that git
+revision, e.g. the commit before a change to compare against:
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_cold_start.py --runs 10 --baseline HEAD~1
+
+Nothing is sent to AWS, the clients are only constructed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import io
+
+import support
+
+FUNCTIONS = ('authorization', 'user', 'blog', 'post', 'sqs_processor', 'compactor')
+
+# Runs in the fresh interpreter: imports app.py, then touches every client and table it holds
+PROBE = r'''
+import importlib.util, json, sys, time
+lambdas, name = sys.argv[1], sys.argv[2]
+sys.path.insert(0, lambdas)
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("app", f"{lambdas}/{name}/app.py")
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+for value in list(vars(module).values()):
+    if hasattr(value, "pending") and hasattr(value, "queue_url"):
+        value.client
+    elif not isinstance(value, type) and type(value).__module__ != "module" and hasattr(value, "meta"):
+        value.meta
+ready = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "total_ms": (ready - start) * 1000}))
+'''
+
+
+def measure(lambdas, name, runs):
+    env = dict(os.environ, APP_REGION=support.REGION, QUEUE_URL='https://sqs.us-east-1.amazonaws.com/0/BlogQueue',
+               BUCKET_NAME='benchmark')
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE, lambdas, name], env=env, check=True,
+                                capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {key: round(statistics.median(sample[key] for sample in samples), 1) for key in ('import_ms', 'total_ms')}
+
+
+# The lambdas/ directory as it was at `revision`, unpacked into `target`
+def checkout(revision, target):
+    archive = subprocess.run(['git', 'archive', revision, 'lambdas'], cwd=support.ROOT, check=True,
+                             capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target)
+    return os.path.join(target, 'lambdas')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--baseline', help='git revision to compare against')
+    parser.add_argument('--functions', nargs='+', default=FUNCTIONS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        baseline = checkout(args.baseline, scratch) if args.baseline else None
+        for name in args.functions:
+            result = {'function': name, 'current': measure(support.LAMBDAS, name, args.runs)}
+            if baseline and os.path.exists(os.path.join(baseline, name, 'app.py')):
+                result['baseline'] = measure(baseline, name, args.runs)
+                result['saved_ms'] = round(result['baseline']['total_ms'] - result['current']['total_ms'], 1)
+            print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Event archive queries: raw per-batch objects vs. the compacted Parquet partitions.
+
+Archives --hours hours of queue batches into an in-memory (moto) bucket through
+the queue processor, runs the same filtered query over the raw objects, compacts
+every hour with the compactor and runs it again. Reports the S3 requests and
+bytes each query needs; the row groups skipped are the predicate pushdown:
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_event_archive.py --hours 6 --batches-per-hour 360
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from moto import mock_aws
+
+from support import REGION, ROOT, load_handler
+
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+from common import events
+from query_events import query_events
+
+BUCKET = 'bench-bucket'
+EVENT_TYPES = [events.POST_CREATED, events.POST_UPDATED, events.POST_DELETED, events.BLOG_UPDATED]
+
+
+def seed(processor, hours, batches_per_hour, batch_size, blogs, rng, start):
+    sent = 0
+    for batch in range(hours * batches_per_hour):
+        now = start + timedelta(seconds=batch * 3600 / batches_per_hour)
+        messages = []
+        for _ in range(batch_size):
+            event = events.make_event(rng.choice(EVENT_TYPES), f'blog-{rng.randrange(blogs)}', 'author', 'post')
+            event['occurred_at'] = now.isoformat()
+            sent += 1
+            messages.append({'messageId': f'message-{sent}', 'body': json.dumps(event),
+                             'attributes': {'SentTimestamp': str(int(now.timestamp() * 1000))}})
+        processor.archive_batch(messages, now)
+    return sent
+
+
+def measure(fn):
+    start = time.perf_counter()
+    table, stats = fn()
+    return table, dict(stats.as_dict(), rows=table.num_rows, emulator_ms=round((time.perf_counter() - start) * 1000, 2))
+
+
+def run(hours, batches_per_hour, batch_size, blogs, seed_value):
+    os.environ['BUCKET_NAME'] = BUCKET
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=REGION)
+        s3.create_bucket(Bucket=BUCKET)
+        processor = load_handler('sqs_processor')
+        compactor = load_handler('compactor')
+        rng = random.Random(seed_value)
+        first_hour = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        messages = seed(processor, hours, batches_per_hour, batch_size, blogs, rng, first_hour)
+
+        query = dict(start=first_hour, end=first_hour + timedelta(hours=hours),
+                     event_types=[events.POST_CREATED], blog_id=f'blog-{rng.randrange(blogs)}')
+        raw_rows, raw = measure(lambda: query_events(s3, BUCKET, include_raw=True, **query))
+        compactor.lambda_handler({}, None)
+        rows, compacted = measure(lambda: query_events(s3, BUCKET, **query))
+        assert raw_rows['message_id'].to_pylist() == rows['message_id'].to_pylist()
+
+        result = {'messages': messages, 'raw': raw, 'compacted': compacted}
+        print(json.dumps(result))
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hours', type=int, default=6)
+    parser.add_argument('--batches-per-hour', type=int, default=360)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--blogs', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=305)
+    args = parser.parse_args()
+    run(args.hours, args.batches_per_hour, args.batch_size, args.blogs, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+"""Load test: every lambda_handler in-process against moto, with a request mix.
+
+Seeds users, blogs, posts and subscriptions, then replays --requests requests
+drawn from a weighted mix of operations from --concurrency threads. Each thread
+loads its own copy of the handlers, like a separate warm container, and every
+request carries the authorizer context API Gateway would add:
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_load.py --users 200 --blogs 50 --posts-per-blog 20 \\
+        --requests 2000 --concurrency 4 --output load.json
+
+Reports p50/p95/p99 latency, throughput, DynamoDB calls, scans and consumed
+capacity per request for each operation, and peak memory, as JSON.
+--max-scans-per-request and --max-calls-per-request exit non-zero when an
+operation goes over them, to catch a scan-per-request regression in CI. moto
+latencies are far from DynamoDB's, compare runs with each other rather than
+with production.
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import queue
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from moto import mock_aws
+
+from support import REGION, create_tables, load_handler  # also puts lambdas/ on the path
+
+from common import metrics
+from common.batch import batch_write
+from common.blogs import popularity_shard
+from common.content import store_content
+from common.search import BLOG, POST, index_document
+from common.timeline import BACKFILL_POSTS, timeline_entry
+
+BUCKET = 'load-test-bucket'
+FUNCTIONS = ('authorization', 'user', 'blog', 'post', 'sqs_processor')
+WORDS = ('serverless', 'python', 'caching', 'latency', 'dynamodb', 'queue', 'index', 'search', 'bread',
+         'travel', 'music', 'garden', 'coffee', 'design', 'testing', 'deploy', 'cloud', 'storage')
+CATEGORIES = ('tech', 'food', 'travel', 'music', 'life')
+
+DEFAULT_MIX = {
+    'get_post': 25, 'get_blog': 10, 'blog_posts': 10, 'popular_blogs': 5, 'feed': 15, 'search': 8,
+    'batch_posts': 3, 'get_user': 3, 'authorize': 8, 'create_post': 4, 'update_post': 3, 'subscribe': 2,
+    'process_queue': 4,
+}
+
+
+class MetricsRecorder:
+    # Keeps the last metrics record each thread's handler emitted, instead of printing it. The
+    # handlers count their own DynamoDB calls, scans and capacity, worker threads included.
+    def __init__(self):
+        self.local = threading.local()
+        metrics.set_sink(self._store)
+
+    def _store(self, record):
+        self.local.record = record
+
+    def take(self):
+        record, self.local.record = getattr(self.local, 'record', None) or {}, None
+        return {'calls': record.get('DynamoDBCalls', 0), 'scans': record.get('DynamoDBScans', 0),
+                'capacity': record.get('DynamoDBCapacity', 0.0)}
+
+
+def basic_auth(user):
+    return 'Basic ' + base64.b64encode(f"{user['username']}:{user['password']}".encode()).decode()
+
+
+def api_event(method, user, resource=None, path=None, query=None, body=None):
+    return {
+        'httpMethod': method,
+        'resource': resource,
+        'headers': {'Authorization': basic_auth(user), 'Accept-Encoding': 'gzip'},
+        'pathParameters': path,
+        'queryStringParameters': query,
+        'body': json.dumps(body) if body is not None else None,
+        'requestContext': {'authorizer': {'user_id': user['Id'], 'username': user['username']}},
+    }
+
+
+def text(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+# Writes the data set straight to the tables, shaped the way the handlers write it, plus the
+# timelines and search index the queue processor would have built
+def seed(args, rng):
+    dynamodb = boto3.resource('dynamodb', region_name=REGION)
+    s3 = boto3.client('s3', region_name=REGION)
+    search_table = dynamodb.Table('BlogSearch')
+    now = datetime.now(timezone.utc)
+
+    users = [{'Id': str(uuid.uuid4()), 'username': f'user{index}', 'password': f'pw{index}', 'version': 1}
+             for index in range(args.users)]
+    blogs, posts, subscriptions, timelines = [], [], [], []
+    for index in range(args.blogs):
+        author = rng.choice(users)
+        subscribers = rng.sample(users, min(args.subscribers_per_blog, len(users)))
+        blog = {'Id': str(uuid.uuid4()), 'author': author['Id'], 'title': f'{text(rng, 2).title()} {index}',
+                'category': rng.choice(CATEGORIES), 'description': text(rng, 12),
+                'subscriber_count': len(subscribers), 'created_at': now.isoformat(), 'version': 1}
+        blog['popularity_shard'] = popularity_shard(blog['Id'])
+        blogs.append(blog)
+        subscriptions.extend({'blog_id': blog['Id'], 'user_id': user['Id']} for user in subscribers)
+
+        blog_posts = []
+        for number in range(args.posts_per_blog):
+            post_id = str(uuid.uuid4())
+            created_at = (now - timedelta(minutes=rng.randrange(60 * 24 * 7))).isoformat().replace('+00:00', 'Z')
+            # a few posts are long enough to be offloaded to S3
+            size = args.large_post_words if rng.random() < args.large_post_ratio else rng.randrange(50, 400)
+            post = {'Id': post_id, 'blog_id': blog['Id'], 'author_id': author['Id'], 'title': f'{text(rng, 3)} {number}',
+                    'created_at': created_at, 'version': 1,
+                    **store_content(s3, BUCKET, blog['Id'], post_id, text(rng, size))}
+            blog_posts.append(post)
+        posts.extend(blog_posts)
+        latest = sorted(blog_posts, key=lambda post: post['created_at'], reverse=True)[:BACKFILL_POSTS]
+        timelines.extend(timeline_entry(user['Id'], post['Id'], blog['Id'], author['Id'], post['title'], post['created_at'])
+                         for user in subscribers for post in latest)
+
+    for table, items in (('BlogUser', users), ('BlogBlog', blogs), ('BlogPost', posts),
+                         ('BlogSubscription', subscriptions), ('BlogTimeline', timelines)):
+        batch_write(dynamodb.Table(table), [{'PutRequest': {'Item': item}} for item in items], workers=4)
+    for blog in blogs:
+        index_document(search_table, BLOG, blog['Id'], blog['title'], f"{blog['category']} {blog['description']}", 1)
+    for post in posts:
+        index_document(search_table, POST, post['Id'], post['title'], post.get('content') or post['excerpt'], 1)
+    return {'users': users, 'blogs': blogs, 'posts': posts, 'subscriptions': subscriptions}
+
+
+class Workload:
+    def __init__(self, data, queue_url):
+        self.data = data
+        self.queue_url = queue_url
+        self.sqs = boto3.client('sqs', region_name=REGION)
+        self.users_by_id = {user['Id']: user for user in data['users']}
+        self.followers = sorted({subscription['user_id'] for subscription in data['subscriptions']})
+
+    def author_of(self, post):
+        return self.users_by_id[post['author_id']]
+
+    # (function, event) for one request of the operation, event is None when there is nothing to do
+    def request(self, operation, rng):
+        data = self.data
+        user = rng.choice(data['users'])
+        blog = rng.choice(data['blogs'])
+        post = rng.choice(data['posts'])
+        if operation == 'authorize':
+            return 'authorization', {'type': 'TOKEN', 'authorizationToken': basic_auth(user),
+                                     'methodArn': 'arn:aws:execute-api:us-east-1:0:api/prod/GET/post'}
+        if operation == 'get_user':
+            return 'user', api_event('GET', user, '/user/id/{id}', {'id': rng.choice(data['users'])['Id']})
+        if operation == 'get_blog':
+            return 'blog', api_event('GET', user, '/blog/id/{id}', {'id': blog['Id']})
+        if operation == 'blog_posts':
+            return 'blog', api_event('GET', user, '/blog/posts/{blog_id}', {'blog_id': blog['Id']}, {'limit': '20'})
+        if operation == 'popular_blogs':
+            return 'blog', api_event('GET', user, '/blog', None, {'limit': '20'})
+        if operation == 'subscribe':
+            return 'blog', api_event('PUT', user, '/blog/subscriptions/{id}', {'id': blog['Id']})
+        if operation == 'get_post':
+            return 'post', api_event('GET', user, '/post/id/{id}', {'id': post['Id']})
+        if operation == 'batch_posts':
+            ids = ','.join(rng.choice(data['posts'])['Id'] for _ in range(20))
+            return 'post', api_event('GET', user, '/post/batch', None, {'ids': ids})
+        if operation == 'feed':
+            follower = self.users_by_id[rng.choice(self.followers)] if self.followers else user
+            return 'post', api_event('GET', follower, '/feed', None, {'limit': '20'})
+        if operation == 'search':
+            return 'post', api_event('GET', user, '/search', None, {'q': text(rng, 2), 'limit': '10'})
+        if operation == 'create_post':
+            author = self.users_by_id[blog['author']]
+            return 'post', api_event('POST', author, '/post',
+                                     body={'blog_id': blog['Id'], 'title': text(rng, 3), 'content': text(rng, 200)})
+        if operation == 'update_post':
+            return 'post', api_event('PUT', self.author_of(post), '/post',
+                                     body={'post_id': post['Id'], 'title': text(rng, 3)})
+        if operation == 'process_queue':
+            messages = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10).get('Messages', [])
+            if not messages:
+                # SQS doesn't invoke the processor for an empty queue either
+                return 'sqs_processor', None
+            for message in messages:
+                self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+            return 'sqs_processor', {'Records': [{
+                'messageId': message['MessageId'], 'body': message['Body'],
+                'attributes': {'SentTimestamp': str(int(time.time() * 1000))}
+            } for message in messages]}
+        raise ValueError(f'unknown operation {operation}')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+def failed(function, result):
+    if function == 'authorization':
+        return result['policyDocument']['Statement'][0]['Effect'] != 'Allow'
+    if function == 'sqs_processor':
+        return bool(result['batchItemFailures'])
+    return result['statusCode'] >= 500
+
+
+def run(args):
+    mix = dict(DEFAULT_MIX)
+    for entry in args.mix or []:
+        name, _, weight = entry.partition('=')
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f'unknown operation {name}, choose from {", ".join(DEFAULT_MIX)}')
+        mix[name] = float(weight)
+    operations = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in operations]
+
+    with mock_aws():
+        create_tables()
+        boto3.client('s3', region_name=REGION).create_bucket(Bucket=BUCKET)
+        queue_url = boto3.client('sqs', region_name=REGION).create_queue(QueueName='BlogQueue')['QueueUrl']
+        os.environ.update(QUEUE_URL=queue_url, BUCKET_NAME=BUCKET)
+
+        rng = random.Random(args.seed)
+        start = time.perf_counter()
+        data = seed(args, rng)
+        seed_seconds = time.perf_counter() - start
+
+        recorder = MetricsRecorder()
+        workload = Workload(data, queue_url)
+        samples = defaultdict(list)
+        first_errors = {}
+        samples_lock = threading.Lock()
+
+        # a set of handlers per unit of concurrency, each serving one request at a time like a warm
+        # container, with its own module state and caches
+        containers = queue.Queue()
+        for _ in range(args.concurrency):
+            containers.put({name: load_handler(name) for name in FUNCTIONS})
+
+        def one(index):
+            request_rng = random.Random(args.seed * 1000003 + index)
+            operation = request_rng.choices(operations, weights)[0]
+            handlers = containers.get()
+            try:
+                function, event = workload.request(operation, request_rng)
+                if event is None:
+                    return
+                began = time.perf_counter()
+                try:
+                    error = failed(function, handlers[function].lambda_handler(event, None))
+                except Exception as err:
+                    error = True
+                    first_errors.setdefault(operation, repr(err))
+                elapsed = time.perf_counter() - began
+                calls = recorder.take()
+            finally:
+                containers.put(handlers)
+            with samples_lock:
+                samples[operation].append(dict(calls, ms=elapsed * 1000, error=error))
+
+        if args.trace_memory:
+            tracemalloc.start()
+        # the handlers log as they go, the report is all that gets printed
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(one, range(args.requests)))
+            wall_seconds = time.perf_counter() - start
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        if args.trace_memory:
+            tracemalloc.stop()
+
+    report = {
+        'config': {name: value for name, value in vars(args).items() if name not in ('output', 'mix')},
+        'mix': mix,
+        'seed_seconds': round(seed_seconds, 2),
+        'requests': args.requests,
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(args.requests / wall_seconds, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'operations': {},
+    }
+    if traced_peak is not None:
+        report['peak_traced_mb'] = round(traced_peak / 1024 / 1024, 1)
+    for operation, entries in sorted(samples.items()):
+        latencies = [entry['ms'] for entry in entries]
+        count = len(entries)
+        report['operations'][operation] = {
+            'count': count,
+            'errors': sum(entry['error'] for entry in entries),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'throughput_rps': round(count / wall_seconds, 1),
+            'dynamodb_calls_per_request': round(sum(entry['calls'] for entry in entries) / count, 2),
+            'scans_per_request': round(sum(entry['scans'] for entry in entries) / count, 2),
+            'capacity_units_per_request': round(sum(entry['capacity'] for entry in entries) / count, 2),
+        }
+        if operation in first_errors:
+            report['operations'][operation]['first_exception'] = first_errors[operation]
+    return report
+
+
+# Operations over the --max-* limits, as messages
+def regressions(report, args):
+    found = []
+    for operation, stats in report['operations'].items():
+        if args.max_scans_per_request is not None and stats['scans_per_request'] > args.max_scans_per_request:
+            found.append(f"{operation}: {stats['scans_per_request']} scans per request")
+        if args.max_calls_per_request is not None and stats['dynamodb_calls_per_request'] > args.max_calls_per_request:
+            found.append(f"{operation}: {stats['dynamodb_calls_per_request']} DynamoDB calls per request")
+        if stats['errors']:
+            found.append(f"{operation}: {stats['errors']} failed request(s)")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--blogs', type=int, default=50)
+    parser.add_argument('--posts-per-blog', type=int, default=20)
+    parser.add_argument('--subscribers-per-blog', type=int, default=20)
+    parser.add_argument('--large-post-ratio', type=float, default=0.05, help='share of posts offloaded to S3')
+    parser.add_argument('--large-post-words', type=int, default=4000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--mix', nargs='*', metavar='OPERATION=WEIGHT', help='override weights of the default mix')
+    parser.add_argument('--seed', type=int, default=305)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also report the peak of Python allocations, runs about 3x slower')
+    parser.add_argument('--max-scans-per-request', type=float)
+    parser.add_argument('--max-calls-per-request', type=float)
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args()
+
+    report = run(args)
+    found = regressions(report, args)
+    report['regressions'] = found
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Response serialization: the old per-lambda json.dumps vs. common/responses.
+
+Builds --items post-like items the way boto3 returns them (Decimal numbers,
+string sets) and times serializing the list --repeat times each way:
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_serialization.py --items 10000
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+from decimal import Decimal
+
+import support  # noqa: F401  puts lambdas/ on the path
+
+from common import responses
+
+
+# What every lambda's response() used before, kept here as the baseline
+def old_json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def old_dumps(body):
+    return json.dumps(body, default=old_json_default)
+
+
+def make_items(count, rng):
+    return [{
+        'Id': str(uuid.UUID(int=rng.getrandbits(128))),
+        'blog_id': str(uuid.UUID(int=rng.getrandbits(128))),
+        'author_id': str(uuid.UUID(int=rng.getrandbits(128))),
+        'title': f'post number {index}',
+        'excerpt': ' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet']) for _ in range(40)),
+        'content_length': Decimal(rng.randrange(100, 100000)),
+        'created_at': '2024-05-01T12:00:00.000000Z',
+        'version': Decimal(rng.randrange(1, 20)),
+        'score': Decimal(str(round(rng.random(), 6))),
+    } for index in range(count)]
+
+
+def best_of(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def run(count, repeat, seed_value):
+    body = {'items': make_items(count, random.Random(seed_value)), 'next_cursor': None}
+    old, old_seconds = best_of(repeat, lambda: old_dumps(body))
+    new, new_seconds = best_of(repeat, lambda: responses.dumps(body))
+    assert json.loads(old) == json.loads(new)
+
+    result = {
+        'items': count,
+        'serializer': 'orjson' if responses.orjson is not None else 'json',
+        'json_dumps': {'ms': round(old_seconds * 1000, 2), 'items_per_s': round(count / old_seconds),
+                       'bytes': len(old.encode())},
+        'responses_dumps': {'ms': round(new_seconds * 1000, 2), 'items_per_s': round(count / new_seconds),
+                            'bytes': len(new.encode())},
+        'speedup': round(old_seconds / new_seconds, 2),
+    }
+    print(json.dumps(result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=305)
+    args = parser.parse_args()
+    run(args.items, args.repeat, args.seed)
+
+
+if __name__ == '__main__':
+    main()
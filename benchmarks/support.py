@@ -0,0 +1,82 @@
+"""Helpers shared by the benchmarks: table setup from template.yaml, loading a
+lambda's app.py in-process and counting what DynamoDB reads on each call."""
+import importlib.util
+import json
+import math
+import os
+import sys
+
+import boto3
+import yaml
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDAS = os.path.join(ROOT, 'lambdas')
+REGION = 'us-east-1'
+
+if LAMBDAS not in sys.path:
+    sys.path.insert(0, LAMBDAS)
+
+os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+
+class _TemplateLoader(yaml.SafeLoader):
+    pass
+
+
+# CloudFormation short tags (!Ref, !GetAtt, ...) don't matter for the table definitions
+_TemplateLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+
+
+def template_resources():
+    with open(os.path.join(ROOT, 'template.yaml')) as template:
+        return yaml.load(template, Loader=_TemplateLoader)['Resources']
+
+
+# Creates every DynamoDB table declared in template.yaml, indexes included
+def create_tables(client=None):
+    client = client or boto3.client('dynamodb', region_name=REGION)
+    for resource in template_resources().values():
+        properties = resource.get('Properties') or {}
+        if resource['Type'] == 'AWS::DynamoDB::Table':
+            client.create_table(**{name: value for name, value in properties.items() if name in (
+                'TableName', 'BillingMode', 'AttributeDefinitions', 'KeySchema', 'GlobalSecondaryIndexes')})
+        elif resource['Type'] == 'AWS::Serverless::SimpleTable':
+            key = properties['PrimaryKey']['Name']
+            client.create_table(
+                TableName=properties['TableName'],
+                BillingMode='PAY_PER_REQUEST',
+                AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}],
+                KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+            )
+
+
+# Imports lambdas/<name>/app.py under a unique module name. Call it inside mock_aws() so the
+# module level boto3 resources talk to the stand-in.
+def load_handler(name):
+    spec = importlib.util.spec_from_file_location(f'{name}_app', os.path.join(LAMBDAS, name, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ReadCounter:
+    # Totals what every Query/Scan response parsed by the client had to read. DynamoDB charges
+    # 0.5 read units per 4 KB read per request (eventually consistent), estimated from the
+    # returned items, which only matches the real cost when no FilterExpression drops any.
+    def __init__(self, client):
+        self.reset()
+        client.meta.events.register('after-call.dynamodb.Query', self._count)
+        client.meta.events.register('after-call.dynamodb.Scan', self._count)
+
+    def _count(self, parsed, **kwargs):
+        self.calls += 1
+        self.scanned += parsed.get('ScannedCount', 0)
+        size = sum(len(json.dumps(item)) for item in parsed.get('Items', []))
+        self.read_units += math.ceil(size / 4096) * 0.5
+
+    def reset(self):
+        self.calls = 0
+        self.scanned = 0
+        self.read_units = 0.0
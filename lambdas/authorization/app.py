@@ -1,57 +1,85 @@
-import json
-import base64
-import boto3
-from base64 import b64decode
+import hashlib
+import time
 import os
+from common import aws, metrics
+from common.cache import TTLCache
+from common.users import decode_basic_auth, get_user_by_credentials
 
-# Initialize DynamoDB resource
-region_name = os.getenv('APP_REGION')
-blog_user_table = boto3.resource('dynamodb', region_name=region_name).Table('BlogUser')
+# DynamoDB table, connected on first use
+blog_user_table = aws.table('BlogUser')
 
+# Results are cached per Authorization header for as long as the container stays warm.
+# Allowed credentials are re-checked against the user's version stamp every AUTH_CACHE_REVALIDATE
+# seconds, so a password change or account deletion is picked up without a full lookup.
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '1024'))
+AUTH_CACHE_ALLOW_TTL = float(os.getenv('AUTH_CACHE_ALLOW_TTL', '300'))
+AUTH_CACHE_DENY_TTL = float(os.getenv('AUTH_CACHE_DENY_TTL', '10'))
+AUTH_CACHE_REVALIDATE = float(os.getenv('AUTH_CACHE_REVALIDATE', '30'))
 
+credential_cache = TTLCache(AUTH_CACHE_SIZE, name="Auth")
+
+
+@metrics.handler('authorization')
 def lambda_handler(event, context):
     # Retrieve the token from the event
     token = event['authorizationToken']
 
-    # Ensure the token starts with "Basic "
-    if not token.startswith("Basic "):
+    # Never keep the raw credentials around, only a hash of the header
+    cache_key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    result = credential_cache.get_or_load(cache_key, lambda: authenticate(token))
+    if result["effect"] == "Allow" and not still_current(result):
+        credential_cache.invalidate(cache_key)
+        result = credential_cache.get_or_load(cache_key, lambda: authenticate(token))
+
+    if result["effect"] == "Allow":
+        return generate_allow_policy(result["user_id"], result["username"])
+    else:
         return generate_deny_policy()
 
-    # Remove "Basic " prefix and decode the remaining Base64 token
-    encoded_credentials = token[6:]
-    decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
 
-    # Split the decoded credentials into username and password
-    username, password = decoded_credentials.split(':', 1)
+# Checks the credentials against the table, returns the cacheable result and how long to keep it
+def authenticate(token):
+    # Ensure the token is "Basic " followed by Base64 encoded username:password
+    credentials = decode_basic_auth(token)
+    if credentials is None:
+        return {"effect": "Deny"}, AUTH_CACHE_DENY_TTL
+    username, password = credentials
 
-    user_id, effect = found_in_db(username, password)
-    if effect == "Allow":
-        return generate_allow_policy(user_id)
-    else:
-        return generate_deny_policy()
+    user = get_user_by_credentials(blog_user_table, username, password)
+    if user is None:
+        return {"effect": "Deny"}, AUTH_CACHE_DENY_TTL
 
-    # except Exception as e:
-    #     print(f"Error: {str(e)}")
-    #     return generate_deny_policy()
+    return {
+        "effect": "Allow",
+        "user_id": user["Id"],
+        "username": username,
+        "version": user.get("version", 0),
+        "checked_at": time.monotonic()
+    }, AUTH_CACHE_ALLOW_TTL
 
 
-def found_in_db(username, password):
-    response = blog_user_table.scan(
-        FilterExpression="username = :username AND password = :password",
-        ExpressionAttributeValues={
-            ':username': username,
-            ':password': password
-        }
-    )
+# update_user and delete_user bump or remove the user's version stamp, reading just that
+# attribute by key is enough to tell whether a cached Allow is still good
+def still_current(result):
+    if time.monotonic() - result["checked_at"] < AUTH_CACHE_REVALIDATE:
+        return True
 
-    if len(response["Items"]) == 1:
-        user_id = response["Items"][0].get("Id")
-        return user_id, "Allow"
-    else:
-        return None, "Deny"
+    item = blog_user_table.get_item(
+        Key={"Id": result["user_id"]},
+        ProjectionExpression="#version",
+        ExpressionAttributeNames={"#version": "version"},
+        ConsistentRead=True
+    ).get("Item")
+    if item is None or item.get("version", 0) != result["version"]:
+        return False
+
+    result["checked_at"] = time.monotonic()
+    return True
 
 
-def generate_allow_policy(user_id):
+# The context is passed on to the resource lambdas as event['requestContext']['authorizer'],
+# so they can trust the caller's guid instead of looking the credentials up again
+def generate_allow_policy(user_id, username):
     return {
         "principalId": user_id,
         "policyDocument": {
@@ -63,11 +91,11 @@ def generate_allow_policy(user_id):
                     "Resource": "*"
                 }
             ]
+        },
+        "context": {
+            "user_id": user_id,
+            "username": username
         }
-        # ,
-        # "context": {
-        #     "user_id": user_id
-        # }
     }
 
 
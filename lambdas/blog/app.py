@@ -1,30 +1,62 @@
-import boto3
-import base64
 from boto3.dynamodb.conditions import Key, Attr
 from os import getenv
 from uuid import uuid4
-import json
-
-region_name = getenv('APP_REGION')
-blog_blog_table = boto3.resource('dynamodb', region_name=region_name).Table('BlogBlog')
-blog_user_table = boto3.resource('dynamodb', region_name=region_name).Table('BlogUser')
-blog_post_table = boto3.resource('dynamodb', region_name=region_name).Table('BlogPost')
+import heapq
+from common import aws, events, metrics
+from common.blogs import SYNC_DELETE_LIMIT, blog_post_keys, blog_subscription_keys, delete_keys, deletion_update
+from common.blogs import BLOG_ETAG_ATTRIBUTES, LOOKUP_INDEXES, POPULARITY_INDEX, POPULARITY_KEY, POPULARITY_SHARDS, popularity_shard
+from common.cache import TTLCache
+from common.conditional import conflict_status, expected_version, not_modified, validators
+from common.content import summary_projection
+from common.items import condition_failure, old_item, parse_timestamp, timestamp, version_condition, versioned_update
+from common.posts import BLOG_POSTS_KEY, blog_posts_query
+from common.pagination import check_key, encode_cursor, get_page_params, paginate
+from common.responses import not_modified_response, request_body, response
+from common.subscriptions import SUBSCRIPTION_KEY, subscribe, subscribers_query, subscriptions_query, unsubscribe
+from common.users import get_current_user_id
+
+# events are buffered while handling a request and sent together once it is done
+publisher = events.EventPublisher()
+
+blog_blog_table = aws.table('BlogBlog')
+blog_user_table = aws.table('BlogUser')
+blog_post_table = aws.table('BlogPost')
+blog_subscription_table = aws.table('BlogSubscription')
+
+# GET /blog/id/{id} reads through a per-container cache. This container's own writes and subscriptions
+# invalidate their blog, BLOG_CACHE_TTL bounds how long changes made elsewhere (another container, the
+# queue processor's deletion progress) can go unseen. BLOG_CACHE_STALE > 0 keeps serving an expired
+# blog for that long while it is reloaded in the background.
+BLOG_CACHE_SIZE = int(getenv('BLOG_CACHE_SIZE', '512'))
+BLOG_CACHE_TTL = float(getenv('BLOG_CACHE_TTL', '5'))
+BLOG_CACHE_STALE = float(getenv('BLOG_CACHE_STALE', '0'))
+
+blog_cache = TTLCache(BLOG_CACHE_SIZE, stale=BLOG_CACHE_STALE, name="Blog")
+
+SUBSCRIPTION_RESOURCES = ("/blog/subscriptions", "/blog/subscriptions/{id}", "/blog/subscribers/{id}")
 
 
 #   This lambda will be locked down to only authenticated users, so we don't need to check for that here,
 #   but we still need to check the http method
+@metrics.handler('blog')
 def lambda_handler(event, context):
+    try:
+        return handle_request(event, context)
+    finally:
+        publisher.flush()
+
+
+def handle_request(event, context):
     http_method = event["httpMethod"]
 
-    # grab the auth header and decode it
-    auth_header = event["headers"]["Authorization"]
-    if not auth_header:
+    # the authorizer hands us the caller's guid, the credentials are only checked again without it
+    current_user_id = get_current_user_id(event, blog_user_table)
+    if current_user_id is None:
         return response(401, "Unauthorized")
-    encoded_credentials = auth_header.split(' ')[1]
-    decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
 
-    current_user_id = get_user_by_username_password(decoded_credentials.split(":")[0],
-                                                    decoded_credentials.split(":")[1])
+    # subscription routes are told apart by resource, /blog/subscribers/{id} shares its path parameter with /blog/id/{id}
+    if event.get("resource") in SUBSCRIPTION_RESOURCES:
+        return handle_subscription(event, context, current_user_id)
 
     if http_method == "GET":
         return get_blog(event, context)
@@ -41,9 +73,7 @@ def lambda_handler(event, context):
 def create_blog(event, context, user_id):
     body = None
     if "body" in event and event["body"] is not None:
-        body = json.loads(event["body"])
-
-    # user_id = event['requestContext']['authorizer']['lambda']['user_id']
+        body = request_body(event)
 
     blog_id = str(uuid4())
     title = body["title"]
@@ -56,79 +86,214 @@ def create_blog(event, context, user_id):
         "title": title,
         "category": category,
         "description": description,
-        "subscribers": []
+        "subscriber_count": 0,
+        "popularity_shard": popularity_shard(blog_id),
+        "created_at": timestamp(),
+        "version": 1
     })
+    publisher.publish(events.BLOG_CREATED, blog_id, user_id, title=title, category=category)
 
     return response(200, {"blog_id": blog_id, "message": "Blog successfully created!"})
 
 
 def get_blog(event, context):
-    print("event:", event)
     path = event["pathParameters"]
-    print("path:", path)
     if path is None:
-        blogs = blog_blog_table.scan()["Items"]
-        blogs = sorted(blogs, key=lambda x: len(x['subscribers']))
-        return response(200, blogs)
+        # most subscribed first, one bounded page per request, ?cursor= from the previous page continues the listing
+        try:
+            limit, start_key = get_page_params(event)
+            check_popular_cursor(start_key)
+        except ValueError as err:
+            return response(400, {"error": str(err)})
+        blogs, next_cursor = get_popular_blogs(limit, start_key)
+        return response(200, {"items": blogs, "next_cursor": next_cursor})
 
     if "id" in path:
         blog_id = path["id"]
-        blog = blog_blog_table.scan(FilterExpression=Attr("Id").eq(blog_id))
-        return response(200, blog)
-    if "title" in path:
-        title = path["title"]
-        blog = blog_blog_table.scan(FilterExpression=Attr('title').eq(title))
-        return response(200, blog)
-    if "category" in path:
-        category = path["category"]
-        blog = blog_blog_table.scan(FilterExpression=Attr('category').eq(category))
-        return response(200, blog)
-    if "author" in path:
-        author = path["author"]
-        blog = blog_blog_table.scan(FilterExpression=Attr('user_id').eq(author))
-        return response(200, blog)
+        blog = blog_cache.get_or_load(blog_id, lambda: (blog_blog_table.get_item(Key={"Id": blog_id}).get("Item"), BLOG_CACHE_TTL))
+        if blog is None:
+            return response(404, "Blog not found")
+        headers = validators(blog, BLOG_ETAG_ATTRIBUTES)
+        if not_modified(event, headers["ETag"]):
+            return not_modified_response(headers)
+        return response(200, blog, headers)
+
+    # the remaining routes return a bounded page at a time, the cursor is a key of the index they read
+    attribute = next((name for name in LOOKUP_INDEXES if name in path), None)
+    try:
+        limit, start_key = get_page_params(event, [attribute, "Id"] if attribute else BLOG_POSTS_KEY)
+    except ValueError as err:
+        return response(400, {"error": str(err)})
+
+    # /blog/title/{title}, /blog/category/{category} and /blog/author/{author} each query their own index
+    if attribute is not None:
+        blogs, next_cursor = paginate(blog_blog_table.query, [attribute, "Id"], limit, start_key,
+                                      IndexName=LOOKUP_INDEXES[attribute],
+                                      KeyConditionExpression=Key(attribute).eq(path[attribute]))
+        return response(200, {"items": blogs, "next_cursor": next_cursor})
+
     if "blog_id" in path:
         blog_id = path["blog_id"]
-        # find all the posts for the blog
-        posts = blog_post_table.scan(FilterExpression=Attr('blog_id').eq(blog_id))["Items"]
-        return response(200, posts)
+        # the blog's posts newest first without their content, ?since= only returns posts created after that time
+        since = (event.get("queryStringParameters") or {}).get("since")
+        if since is not None:
+            try:
+                since = parse_timestamp(since)
+            except ValueError:
+                return response(400, {"error": "since must be an ISO 8601 timestamp"})
+        posts, next_cursor = paginate(blog_post_table.query, BLOG_POSTS_KEY, limit, start_key,
+                                      **blog_posts_query(blog_id, since), **summary_projection())
+        return response(200, {"items": posts, "next_cursor": next_cursor})
 
 
 def update_blog(event, context, user_id):
-    # user_id = event['requestContext']['authorizer']['lambda']['user_id']
     if user_id is None:
         return response(401, "Unauthorized")
 
+    # If-Match is read before the body replaces the event
+    request = event
     if "body" in event and event["body"] is not None:
-        event = json.loads(event["body"])
-
-    title = event["title"]
-    category = event["category"]
-    description = event["description"]
-    blog_id = event["id"]
+        event = request_body(event)
 
+    blog_id = event.get("id")
     if blog_id is None:
         return response(400, "Blog id not found")
 
-    blog = blog_blog_table.get_item(Key={"Id": blog_id})["Item"]
-    if blog is None:
-        return response(400, "Blog not found")
+    try:
+        version, if_match = expected_version(request, event.get("expected_version"))
+    except ValueError as err:
+        return response(400, {"error": str(err)})
 
-    if blog['author'] == user_id:
-        if title != "":
-            blog['title'] = title
-        if category != "":
-            blog['category'] = category
-        if description != "":
-            blog['description'] = description
+    # the author's edit is one conditional update of just the supplied fields, when it fails
+    # the old item that comes back with the error tells us why
+    changes = {name: event[name] for name in ("title", "category", "description") if event.get(name, "") != ""}
+    try:
+        blog = blog_blog_table.update_item(
+            Key={"Id": blog_id},
+            **versioned_update(changes, Attr("Id").exists() & Attr("author").eq(user_id), version)
+        )["Attributes"]
+        blog_cache.invalidate(blog_id)
+        publisher.publish(events.BLOG_UPDATED, blog_id, user_id, fields=sorted(changes), version=blog["version"])
+        return response(200, blog, validators(blog, BLOG_ETAG_ATTRIBUTES))
+    except blog_blog_table.meta.client.exceptions.ConditionalCheckFailedException as err:
+        blog = old_item(err)
+        code, message = condition_failure(err, "author", user_id)
+        if code != 401:
+            return response(conflict_status(code, if_match), message)
+
+    # anyone else sending a PUT subscribes to the blog, unless it is on its way out
+    created = subscribe(blog_subscription_table, blog_blog_table, blog_id, user_id)
+    if created is None:
+        return response(409, "Blog is being deleted")
+    if created:
+        blog_cache.invalidate(blog_id)
+        blog["subscriber_count"] = blog.get("subscriber_count", 0) + 1
+        publisher.publish(events.SUBSCRIPTION_CREATED, blog_id, blog.get("author"), user_id=user_id)
+    return response(200, blog)
 
-        blog_blog_table.put_item(Item=blog)
 
-        return response(200, blog)
+# PUT/DELETE /blog/subscriptions/{id} subscribe to or unsubscribe from a blog, GET /blog/subscriptions lists
+# the blogs the caller follows and GET /blog/subscribers/{id} lists a blog's subscribers, a page at a time
+def handle_subscription(event, context, user_id):
+    http_method = event["httpMethod"]
+    path = event.get("pathParameters") or {}
+    blog_id = path.get("id")
 
-    blog['subscribers'].append(user_id)
-    blog_blog_table.put_item(Item=blog)
-    return response(200, blog)
+    if http_method == "GET":
+        try:
+            limit, start_key = get_page_params(event, SUBSCRIPTION_KEY)
+        except ValueError as err:
+            return response(400, {"error": str(err)})
+        if blog_id is None:
+            items, next_cursor = paginate(blog_subscription_table.query, SUBSCRIPTION_KEY, limit, start_key,
+                                          **subscriptions_query(user_id))
+            return response(200, {"items": [item["blog_id"] for item in items], "next_cursor": next_cursor})
+        items, next_cursor = paginate(blog_subscription_table.query, SUBSCRIPTION_KEY, limit, start_key,
+                                      **subscribers_query(blog_id))
+        return response(200, {"items": [item["user_id"] for item in items], "next_cursor": next_cursor})
+
+    if blog_id is None:
+        return response(400, "no id found")
+    if http_method == "PUT":
+        created = subscribe(blog_subscription_table, blog_blog_table, blog_id, user_id)
+        if created is None:
+            # the blog is gone, or marked for deletion and about to be
+            blog = blog_blog_table.get_item(Key={"Id": blog_id}, ProjectionExpression="Id").get("Item")
+            return response(409, "Blog is being deleted") if blog else response(404, "Blog not found")
+        if created:
+            blog_cache.invalidate(blog_id)
+            publisher.publish(events.SUBSCRIPTION_CREATED, blog_id, None, user_id=user_id)
+        return response(200, {"blog_id": blog_id, "subscribed": True, "created": created})
+    if http_method == "DELETE":
+        removed = unsubscribe(blog_subscription_table, blog_blog_table, blog_id, user_id)
+        if removed is None:
+            return response(404, "Blog not found")
+        if removed:
+            blog_cache.invalidate(blog_id)
+            publisher.publish(events.SUBSCRIPTION_DELETED, blog_id, None, user_id=user_id)
+        return response(200, {"blog_id": blog_id, "subscribed": False, "removed": removed})
+    return response(400, "invalid http method")
+
+
+# A popular blogs cursor has a position for every shard: {} to start, the key of the last blog
+# returned, or None once the shard is used up. Raises ValueError.
+def check_popular_cursor(cursor):
+    if cursor is None:
+        return
+    if set(cursor) != {str(shard) for shard in range(POPULARITY_SHARDS)}:
+        raise ValueError("invalid cursor")
+    for shard, position in cursor.items():
+        if position is not None and not isinstance(position, dict):
+            raise ValueError("invalid cursor")
+        if position:
+            check_key(position, POPULARITY_KEY, number_names=("popularity_shard", "subscriber_count"))
+            if position["popularity_shard"] != int(shard):
+                raise ValueError("invalid cursor")
+
+
+# Returns the `limit` most subscribed blogs after the cursor position. Each shard of the
+# popularity index is read in descending subscriber order and the shards are merged, so a page
+# costs at most POPULARITY_SHARDS * limit index reads however many blogs exist. The cursor keeps
+# the position reached in every shard (None once a shard is used up).
+def get_popular_blogs(limit, cursor):
+    positions = cursor or {str(shard): {} for shard in range(POPULARITY_SHARDS)}
+
+    pages = {}
+    for shard, start_key in positions.items():
+        if start_key is None:
+            continue
+        request = {
+            "IndexName": POPULARITY_INDEX,
+            "KeyConditionExpression": Key("popularity_shard").eq(int(shard)),
+            "ScanIndexForward": False,
+            "Limit": limit
+        }
+        if start_key:
+            request["ExclusiveStartKey"] = start_key
+        page = blog_blog_table.query(**request)
+        pages[shard] = (page["Items"], "LastEvaluatedKey" in page)
+
+    # every shard's page is already sorted, so a k-way merge gives the global order
+    merged = heapq.merge(*([(shard, item) for item in items] for shard, (items, _) in pages.items()),
+                         key=lambda entry: entry[1]["subscriber_count"], reverse=True)
+    blogs = []
+    consumed = {shard: 0 for shard in pages}
+    next_positions = dict(positions)
+    for shard, item in merged:
+        if len(blogs) == limit:
+            break
+        blogs.append(item)
+        consumed[shard] += 1
+        next_positions[shard] = {name: item[name] for name in POPULARITY_KEY}
+
+    # a shard is used up once everything it returned was consumed and the index holds no more
+    for shard, (items, more) in pages.items():
+        if not more and consumed[shard] == len(items):
+            next_positions[shard] = None
+
+    if all(position is None for position in next_positions.values()):
+        return blogs, None
+    return blogs, encode_cursor(next_positions)
 
 
 def delete_blog(event, context, user_id):
@@ -137,42 +302,49 @@ def delete_blog(event, context, user_id):
     path = event["pathParameters"]
     if path is None or "id" not in path:
         return response(400, "no id found")
-    # user_id = event['requestContext']['authorizer']['lambda']['user_id']
     blog_id = path["id"]
 
     try:
-        blog = blog_blog_table.get_item(Key={"Id": blog_id})["Item"]
-    except KeyError:
-        return response(400, "Blog not found")
+        version, if_match = expected_version(event, (event.get("queryStringParameters") or {}).get("expected_version"))
+    except ValueError as err:
+        return response(400, {"error": str(err)})
 
-    # if blog is None:
-    #     return response(400, "Blog not found")
+    condition = Attr("Id").exists() & Attr("author").eq(user_id)
+    if version is not None:
+        condition = condition & version_condition(version)
 
-    if blog['author'] != user_id:
-        return response(401, "Unauthorized")
-
-    output = blog_blog_table.delete_item(Key={"Id": blog_id})
-
-    return response(200, output)
-
-
-def get_user_by_username_password(username, password):
-    # find the user in the table
-    user = blog_user_table.scan(FilterExpression=Attr('username').eq(username) & Attr('password').eq(password))
-    # if the user is found, return their guid
-    if len(user["Items"]) == 1:
-        return user["Items"][0]["Id"]
-    # if the user is not found, return None
-    else:
-        return None
-
-
-def response(code, body):
-    return {
-        "statusCode": code,
-        "headers": {
-            "Content-Type": "application/json"
-        },
-        "body": json.dumps(body),
-        "isBase64Encoded": False
-    }
+    # mark the blog first, deleting a blog that is already being deleted restarts the cleanup
+    try:
+        blog = blog_blog_table.update_item(
+            Key={"Id": blog_id},
+            ConditionExpression=condition,
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            **deletion_update()
+        )["Attributes"]
+    except blog_blog_table.meta.client.exceptions.ConditionalCheckFailedException as err:
+        code, message = condition_failure(err, "author", user_id)
+        return response(conflict_status(code, if_match), message)
+    blog_cache.invalidate(blog_id)
+
+    # small blogs are cleaned up right here with parallel batch deletes
+    post_keys = blog_post_keys(blog_post_table, blog_id, SYNC_DELETE_LIMIT + 1)
+    if len(post_keys) + blog.get("subscriber_count", 0) <= SYNC_DELETE_LIMIT:
+        posts_deleted = delete_keys(blog_post_table, post_keys)
+        subscription_keys = blog_subscription_keys(blog_subscription_table, blog_id, SYNC_DELETE_LIMIT + 1)
+        if posts_deleted == len(post_keys) and len(subscription_keys) <= SYNC_DELETE_LIMIT:
+            # the queue processor takes the blog out of the subscribers' timelines
+            for key in subscription_keys:
+                publisher.publish(events.SUBSCRIPTION_DELETED, blog_id, user_id, user_id=key["user_id"])
+            subscriptions_deleted = delete_keys(blog_subscription_table, subscription_keys) == len(subscription_keys)
+        else:
+            subscriptions_deleted = False
+        if subscriptions_deleted:
+            blog_blog_table.delete_item(Key={"Id": blog_id})
+            publisher.publish(events.BLOG_DELETED, blog_id, user_id, posts_deleted=posts_deleted,
+                              post_ids=[key["Id"] for key in post_keys])
+            return response(200, {"blog_id": blog_id, "status": "deleted", "posts_deleted": posts_deleted})
+
+    # anything bigger (or a cleanup that didn't finish) continues in the queue processor,
+    # GET /blog/id/{id} shows its progress until the blog is gone
+    publisher.publish(events.BLOG_DELETE_REQUESTED, blog_id, user_id)
+    return response(202, {"blog_id": blog_id, "status": "deleting", "posts_deleted": blog["posts_deleted"]})
@@ -0,0 +1,116 @@
+import gzip
+import io
+import json
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+# The queue processor writes one gzip JSON Lines object per batch under RAW_PREFIX, the compactor
+# merges each finished hour into Parquet under COMPACTED_PREFIX. Both use the same partitions:
+# <prefix>/dt=YYYY-MM-DD/hour=HH/
+RAW_PREFIX = "events"
+COMPACTED_PREFIX = "compacted"
+
+# Columns of the compacted files. occurred_at is the event's own time, or when SQS received the
+# message for bodies that aren't events. data holds the event's payload as JSON, body the text of
+# anything that wasn't JSON.
+STRING_COLUMNS = ("message_id", "event_id", "event_type", "blog_id", "post_id", "author_id", "data", "body")
+
+
+def partition_prefix(prefix, moment):
+    return f"{prefix}/dt={moment:%Y-%m-%d}/hour={moment:%H}/"
+
+
+# Random suffix, so objects written in the same second never replace each other
+def object_key(prefix, moment, extension):
+    return f"{partition_prefix(prefix, moment)}{moment:%Y%m%dT%H%M%S}-{uuid4().hex}.{extension}"
+
+
+# The hour a key belongs to, or None for keys outside the partition layout
+def partition_hour(key):
+    try:
+        day, hour = key.split("/")[1:3]
+        return datetime.strptime(f"{day} {hour}", "dt=%Y-%m-%d hour=%H").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def hours_between(start, end):
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour < end:
+        yield hour
+        hour += timedelta(hours=1)
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def read_raw(payload):
+    return [json.loads(line) for line in gzip.decompress(payload).decode().splitlines() if line]
+
+
+# Flattens one archived line into a row of the compacted layout
+def to_row(record):
+    event = record.get("event") or {}
+    sent_at = datetime.fromtimestamp(record.get("sent_at", 0) / 1000, timezone.utc)
+    row = {name: event.get(name) for name in ("event_id", "event_type", "blog_id", "post_id", "author_id")}
+    row.update({
+        "message_id": record["message_id"],
+        "occurred_at": parse_time(event.get("occurred_at")) or sent_at,
+        "sent_at": sent_at,
+        "schema_version": event.get("schema_version"),
+        "data": json.dumps(event["data"]) if "data" in event else None,
+        "body": record.get("body")
+    })
+    return row
+
+
+# pyarrow is only needed by the compactor and the query tool, not by every lambda that shares common/
+def arrow_schema():
+    import pyarrow as pa
+    return pa.schema(
+        [pa.field("occurred_at", pa.timestamp("us", tz="UTC")), pa.field("sent_at", pa.timestamp("ms", tz="UTC")),
+         pa.field("schema_version", pa.int32())] + [pa.field(name, pa.string()) for name in STRING_COLUMNS]
+    )
+
+
+# A read-only file over an S3 object that fetches only the byte ranges asked for, so Parquet readers
+# can get the footer and the column chunks they need without downloading the whole object
+class S3RangeReader(io.RawIOBase):
+    def __init__(self, client, bucket, key, size=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size if size is not None else client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.position = 0
+        self.requests = 0
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.size, self.position + len(buffer))
+        if end <= self.position:
+            return 0
+        body = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                      Range=f"bytes={self.position}-{end - 1}")["Body"].read()
+        buffer[:len(body)] = body
+        self.position += len(body)
+        self.requests += 1
+        self.bytes_read += len(body)
+        return len(body)
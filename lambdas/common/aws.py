@@ -0,0 +1,68 @@
+import threading
+from os import getenv
+import boto3
+from botocore.config import Config
+from common import metrics
+
+# One client per service and one DynamoDB resource per container, all created the first time they
+# are used rather than at import. Invocations that never touch a service never pay for its client,
+# and the tables a lambda reads share one resource and so one connection pool.
+region_name = getenv('APP_REGION')
+
+# Short connect timeouts so a bad connection is retried instead of eating the function's timeout,
+# keep-alive so warm containers reuse connections, and adaptive retries that also slow down when
+# DynamoDB throttles. The pool is big enough for the threads batch_write and the fan-out start.
+CONFIG = Config(
+    connect_timeout=float(getenv('AWS_CONNECT_TIMEOUT', '1')),
+    read_timeout=float(getenv('AWS_READ_TIMEOUT', '10')),
+    retries={"mode": "adaptive", "max_attempts": int(getenv('AWS_MAX_ATTEMPTS', '5'))},
+    max_pool_connections=int(getenv('AWS_MAX_POOL_CONNECTIONS', '32')),
+    tcp_keepalive=True
+)
+
+_lock = threading.Lock()
+_clients = {}
+_resources = {}
+
+
+# Stands in for a client or table until an attribute is first read, then forwards to the real one
+class Lazy:
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+def _client(service):
+    with _lock:
+        if service not in _clients:
+            _clients[service] = metrics.instrument(boto3.client(service, region_name=region_name, config=CONFIG), service)
+        return _clients[service]
+
+
+def _resource(service):
+    with _lock:
+        if service not in _resources:
+            _resources[service] = boto3.resource(service, region_name=region_name, config=CONFIG)
+            metrics.instrument(_resources[service].meta.client, service)
+        return _resources[service]
+
+
+# The shared client for `service`, e.g. client('s3')
+def client(service):
+    return Lazy(lambda: _client(service))
+
+
+# The DynamoDB table `name` on the shared resource
+def table(name):
+    return Lazy(lambda: _resource('dynamodb').Table(name))
@@ -0,0 +1,61 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from common import metrics
+
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 1.0
+
+
+# Exponential backoff with full jitter between retries of unprocessed items
+def backoff(attempt):
+    time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+# Reads `keys` from `table` with BatchGetItem, 100 keys per call, retrying unprocessed keys.
+# Keys must be unique. Returns (items found, keys that were still unprocessed after the retries).
+def batch_get(table, keys, **options):
+    client = table.meta.client
+    items = []
+    failed = []
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {table.name: dict(options, Keys=keys[start:start + BATCH_GET_SIZE])}
+        for attempt in range(MAX_ATTEMPTS):
+            result = client.batch_get_item(RequestItems=request)
+            items.extend(result["Responses"].get(table.name, []))
+            request = result.get("UnprocessedKeys") or {}
+            if not request:
+                break
+            backoff(attempt)
+        if request:
+            failed.extend(request[table.name]["Keys"])
+    return items, failed
+
+
+# Sends write requests ({"PutRequest": ...} or {"DeleteRequest": ...}) to `table` with BatchWriteItem,
+# 25 per call, retrying unprocessed ones. With workers > 1 the chunks are sent in parallel.
+# Returns the requests that still failed after the retries.
+def batch_write(table, requests, workers=1):
+    client = table.meta.client
+    chunks = [requests[start:start + BATCH_WRITE_SIZE] for start in range(0, len(requests), BATCH_WRITE_SIZE)]
+    if workers > 1 and len(chunks) > 1:
+        # boto3 clients are thread safe, resources are not, so the workers share the client
+        with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+            results = list(pool.map(metrics.bind(lambda chunk: _write_chunk(client, table.name, chunk)), chunks))
+    else:
+        results = [_write_chunk(client, table.name, chunk) for chunk in chunks]
+    return [request for failed in results for request in failed]
+
+
+def _write_chunk(client, table_name, chunk):
+    request = {table_name: chunk}
+    for attempt in range(MAX_ATTEMPTS):
+        result = client.batch_write_item(RequestItems=request)
+        request = result.get("UnprocessedItems") or {}
+        if not request:
+            return []
+        backoff(attempt)
+    return request[table_name]
@@ -0,0 +1,65 @@
+import zlib
+from boto3.dynamodb.conditions import Key
+from common.batch import batch_write
+from common.items import timestamp
+from common.posts import BLOG_POSTS_INDEX
+
+# Blogs are spread over a few partitions of the popularity index so that busy blogs don't all
+# write to the same index key. Ranking queries read the top of every shard and merge them.
+POPULARITY_INDEX = 'popularity-index'
+POPULARITY_SHARDS = 4
+POPULARITY_KEY = ["Id", "popularity_shard", "subscriber_count"]
+
+# Attributes that change without a version bump and so are part of a blog's ETag
+BLOG_ETAG_ATTRIBUTES = ("subscriber_count", "deletion_status", "posts_deleted")
+
+# BlogBlog attribute -> the GSI that looks blogs up by it
+LOOKUP_INDEXES = {
+    "title": 'title-index',
+    "category": 'category-index',
+    "author": 'author-index'
+}
+
+
+def popularity_shard(blog_id):
+    return zlib.crc32(blog_id.encode("utf-8")) % POPULARITY_SHARDS
+
+
+# Deleting a blog also deletes its posts and subscriptions. Blogs with up to SYNC_DELETE_LIMIT of
+# them together are cleaned up inside the API call, larger ones by the queue processor.
+SYNC_DELETE_LIMIT = 250
+DELETE_WORKERS = 8
+
+
+# update_item arguments that mark a blog as being deleted. No new posts land on it while it's cleaned
+# up, and it leaves the popularity index. Marking a blog that is already being deleted changes nothing.
+def deletion_update():
+    return {
+        "UpdateExpression": "SET deletion_status = :deleting, deletion_requested_at = if_not_exists(deletion_requested_at, :now), "
+                            "posts_deleted = if_not_exists(posts_deleted, :zero) REMOVE popularity_shard",
+        "ExpressionAttributeValues": {":deleting": "deleting", ":now": timestamp(), ":zero": 0},
+        "ReturnValues": "ALL_NEW"
+    }
+
+
+# Keys of up to `limit` of the blog's posts
+def blog_post_keys(post_table, blog_id, limit):
+    page = post_table.query(
+        IndexName=BLOG_POSTS_INDEX,
+        KeyConditionExpression=Key("blog_id").eq(blog_id),
+        ProjectionExpression="Id",
+        Limit=limit
+    )
+    return [{"Id": item["Id"]} for item in page["Items"]]
+
+
+# Keys of up to `limit` of the blog's subscriptions
+def blog_subscription_keys(subscription_table, blog_id, limit):
+    page = subscription_table.query(KeyConditionExpression=Key("blog_id").eq(blog_id), Limit=limit)
+    return [{"blog_id": item["blog_id"], "user_id": item["user_id"]} for item in page["Items"]]
+
+
+# Deletes the keys with parallel BatchWriteItem calls, returns how many were deleted
+def delete_keys(table, keys, workers=DELETE_WORKERS):
+    failed = batch_write(table, [{"DeleteRequest": {"Key": key}} for key in keys], workers)
+    return len(keys) - len(failed)
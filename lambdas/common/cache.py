@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import OrderedDict
+from common import metrics
+
+
+# Bounded LRU cache whose entries each expire after their own TTL. It lives at module level,
+# so it survives between invocations of a warm container.
+#
+# With `stale` > 0 an expired entry is still served for up to that many seconds while one
+# background load replaces it (stale-while-revalidate). Lambda freezes the container between
+# invocations, so that load finishes later in the same invocation or right after the next thaw.
+#
+# A cache with a `name` counts every get_or_load() into the current request's metrics as
+# <name>CacheHits, <name>CacheStaleHits or <name>CacheMisses, and what a hit saved, going by the
+# average load time, as <name>CacheSavedTime. Unlike the container's own counters these add up
+# across containers.
+class TTLCache:
+    def __init__(self, max_size, clock=time.monotonic, stale=0, name=None):
+        self.max_size = max_size
+        self.name = name
+        self.clock = clock
+        self.stale = stale
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+        # bumped by every invalidation, a load that started before one doesn't store its result
+        self._generation = 0
+
+    # Returns the cached value, or None if the key is missing or expired
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            now = self.clock()
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None and entry[1] + self.stale <= now:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, ttl):
+        with self._lock:
+            self._put(key, value, ttl)
+
+    def _put(self, key, value, ttl):
+        self._entries[key] = (value, self.clock() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    # Read-through: on a miss loader() is called and must return (value, ttl). Concurrent misses
+    # for the same key wait for a single load instead of all hitting the backing store.
+    def get_or_load(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            now = self.clock()
+            saved = self.load_seconds / self.loads if self.loads else 0.0
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._report("Hits", saved)
+                return entry[0]
+            if entry is not None and entry[1] + self.stale > now:
+                self.stale_hits += 1
+                if key not in self._loading:
+                    self._loading[key] = threading.Lock()
+                    threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                self._report("StaleHits", saved)
+                return entry[0]
+            self.misses += 1
+            self._report("Misses")
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > self.clock():
+                    return entry[0]
+            try:
+                return self._load(key, loader)
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+    def _report(self, outcome, saved=0.0):
+        if self.name is not None:
+            metrics.add(f"{self.name}Cache{outcome}")
+            if saved:
+                metrics.add(f"{self.name}CacheSavedTime", saved * 1000, "Milliseconds")
+
+    def _load(self, key, loader):
+        with self._lock:
+            generation = self._generation
+        start = time.perf_counter()
+        value, ttl = loader()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.loads += 1
+            self.load_seconds += elapsed
+            if generation == self._generation:
+                self._put(key, value, ttl)
+        return value
+
+    def _refresh(self, key, loader):
+        try:
+            self._load(key, loader)
+        except Exception as err:
+            # the stale entry keeps being served until its window runs out
+            print("cache refresh failed:", key, err)
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    # Counters since the container started. saved_ms estimates the backing store time hits
+    # avoided, from the average time a load took.
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            average = self.load_seconds / self.loads if self.loads else 0.0
+            return {
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+                "avg_load_ms": round(average * 1000, 3),
+                "saved_ms": round((self.hits + self.stale_hits) * average * 1000, 1)
+            }
@@ -0,0 +1,79 @@
+from datetime import datetime
+from email.utils import format_datetime
+from common.items import parse_version
+
+# HTTP conditional requests on versioned items. An item's ETag is its version, which every edit bumps,
+# followed by any `volatile` attributes that change without a version bump (a blog's subscriber_count
+# moves on every subscribe, bumping the version for it would make the author's edits conflict).
+# When one item has several representations, `variant` names the one sent, so a tag cached for one
+# never matches another.
+
+
+def etag(item, volatile=(), variant=None):
+    parts = [str(int(item.get("version", 0)))] + [str(item.get(name, "")) for name in volatile]
+    if variant:
+        parts.append(variant)
+    return '"' + "-".join(parts) + '"'
+
+
+# ETag and Last-Modified headers for a GET or write response
+def validators(item, volatile=(), variant=None):
+    headers = {"ETag": etag(item, volatile, variant)}
+    modified = item.get("updated_at") or item.get("created_at")
+    if modified:
+        headers["Last-Modified"] = format_datetime(datetime.fromisoformat(modified.replace("Z", "+00:00")), usegmt=True)
+    return headers
+
+
+def header(event, name):
+    for key, value in (event.get("headers") or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def _tags(value):
+    return [tag.strip().removeprefix("W/") for tag in value.split(",") if tag.strip()]
+
+
+# True if If-None-Match names the current tag (weak comparison), the GET is then answered with a 304
+def not_modified(event, tag):
+    value = header(event, "If-None-Match")
+    if value is None:
+        return False
+    tags = _tags(value)
+    return "*" in tags or tag in tags
+
+
+# The version an If-Match header requires, for the write's own condition. Only the version part of the
+# tag is compared, changes to volatile attributes don't get in the way of edits. Returns None without
+# the header or for "*", which only requires the item to exist, as every write already does.
+# Raises ValueError for anything else.
+def if_match_version(event):
+    value = header(event, "If-Match")
+    if value is None:
+        return None
+    tags = _tags(value)
+    if "*" in tags:
+        return None
+    versions = {tag.strip('"').split("-")[0] for tag in tags}
+    if len(versions) != 1:
+        raise ValueError("If-Match must name one version")
+    try:
+        return parse_version(versions.pop())
+    except ValueError:
+        raise ValueError("If-Match is not a tag this API returned")
+
+
+# The version a write must find: If-Match when the request has one, otherwise expected_version from
+# the body or query string. Returns (version, whether it came from If-Match). Raises ValueError.
+def expected_version(event, supplied):
+    version = if_match_version(event)
+    if version is not None:
+        return version, True
+    return parse_version(supplied), False
+
+
+# A version conflict on a write guarded by If-Match is a failed precondition
+def conflict_status(code, if_match):
+    return 412 if if_match and code == 409 else code
@@ -0,0 +1,95 @@
+import gzip
+import hashlib
+import io
+
+# Post content over INLINE_CONTENT_LIMIT bytes is stored gzip compressed in S3 under
+# posts/<blog_id>/<post_id>/<sha256>.gz and the BlogPost item only keeps content_key. Every post
+# carries an excerpt, the content's sha256 and its length in characters.
+CONTENT_PREFIX = "posts"
+INLINE_CONTENT_LIMIT = 16 * 1024
+EXCERPT_LENGTH = 280
+# Attributes one way of storing content leaves behind when a post switches to the other
+STORED_CONTENT_ATTRIBUTES = ("content", "content_key")
+# What listings return of a post, everything but the content
+POST_SUMMARY_FIELDS = ("Id", "blog_id", "author_id", "title", "excerpt", "content_length", "content_hash",
+                       "created_at", "updated_at", "version")
+SKIP_CHUNK = 64 * 1024
+
+
+# ProjectionExpression arguments that read a post without its content
+def summary_projection():
+    return {
+        "ProjectionExpression": ", ".join(f"#{name}" for name in POST_SUMMARY_FIELDS),
+        "ExpressionAttributeNames": {f"#{name}": name for name in POST_SUMMARY_FIELDS}
+    }
+
+
+def excerpt(content):
+    if len(content) <= EXCERPT_LENGTH:
+        return content
+    cut = content[:EXCERPT_LENGTH]
+    # end on a word boundary when there is one in the second half
+    if " " in cut[EXCERPT_LENGTH // 2:]:
+        cut = cut[:cut.rindex(" ")]
+    return cut.rstrip() + "…"
+
+
+def needs_offload(content):
+    return len(content.encode("utf-8")) > INLINE_CONTENT_LIMIT
+
+
+def content_prefix(blog_id, post_id=None):
+    return f"{CONTENT_PREFIX}/{blog_id}/" + (f"{post_id}/" if post_id else "")
+
+
+# The attributes to store for `content`, uploading it first when it is too big to keep inline
+# (blog_id is only needed then). Keys are content addressed, so a write that loses its condition
+# check never replaces the object the post still points at.
+def store_content(s3, bucket, blog_id, post_id, content):
+    encoded = content.encode("utf-8")
+    fields = {
+        "excerpt": excerpt(content),
+        "content_hash": hashlib.sha256(encoded).hexdigest(),
+        "content_length": len(content)
+    }
+    if len(encoded) <= INLINE_CONTENT_LIMIT:
+        fields["content"] = content
+        return fields
+
+    fields["content_key"] = f"{content_prefix(blog_id, post_id)}{fields['content_hash']}.gz"
+    s3.put_object(Bucket=bucket, Key=fields["content_key"], Body=gzip.compress(encoded),
+                  ContentType="text/plain; charset=utf-8", ContentEncoding="gzip")
+    return fields
+
+
+# Deletes the object store_content() uploaded for a write that then failed. Content keys are shared by
+# identical content, so the object stays if `current`, the post as it is stored, still points at it.
+def discard_content(s3, bucket, fields, current=None):
+    key = fields.get("content_key")
+    if key is not None and key != (current or {}).get("content_key"):
+        s3.delete_object(Bucket=bucket, Key=key)
+
+
+# The stored attributes the other way of storing content used, to REMOVE them on update
+def stale_content_attributes(fields):
+    return [name for name in STORED_CONTENT_ATTRIBUTES if name not in fields]
+
+
+# Returns `length` characters of the post's content from `offset` on, all of it when length is None.
+# Offloaded content is decompressed as it streams from S3 and the download stops once the range is read.
+def read_content(s3, bucket, post, offset=0, length=None):
+    if "content_key" not in post:
+        content = post.get("content", "")
+        return content[offset:] if length is None else content[offset:offset + length]
+
+    body = s3.get_object(Bucket=bucket, Key=post["content_key"])["Body"]
+    try:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding="utf-8") as stream:
+            while offset > 0:
+                skipped = len(stream.read(min(offset, SKIP_CHUNK)))
+                if not skipped:
+                    break
+                offset -= skipped
+            return stream.read() if length is None else stream.read(length)
+    finally:
+        body.close()
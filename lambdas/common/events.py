@@ -0,0 +1,101 @@
+import json
+from os import getenv
+from uuid import uuid4
+from botocore.exceptions import BotoCoreError, ClientError
+from common import aws
+from common.batch import MAX_ATTEMPTS, backoff
+from common.items import timestamp
+
+# Bumped whenever a field is removed or changes meaning, consumers check it before reading the rest
+SCHEMA_VERSION = 1
+
+POST_CREATED = "post.created"
+POST_UPDATED = "post.updated"
+POST_DELETED = "post.deleted"
+BLOG_CREATED = "blog.created"
+BLOG_UPDATED = "blog.updated"
+BLOG_DELETED = "blog.deleted"
+BLOG_DELETE_REQUESTED = "blog.delete_requested"
+# author_id is the blog's author when known, the subscriber is data.user_id
+SUBSCRIPTION_CREATED = "subscription.created"
+SUBSCRIPTION_DELETED = "subscription.deleted"
+# no blog_id, the deleted user is author_id
+USER_DELETED = "user.deleted"
+
+SEND_BATCH_SIZE = 10
+
+
+# Every message on the queue is one of these envelopes, serialized as JSON
+def make_event(event_type, blog_id, author_id, post_id=None, **data):
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "event_id": str(uuid4()),
+        "event_type": event_type,
+        "occurred_at": timestamp(),
+        "blog_id": blog_id,
+        "post_id": post_id,
+        "author_id": author_id,
+        "data": data
+    }
+
+
+# Collects the events of one invocation and sends them with SendMessageBatch when flush() is called,
+# usually once at the end of the handler. The SQS client is only created the first time there is
+# something to send, so invocations that publish nothing never pay for it.
+class EventPublisher:
+    def __init__(self, queue_url=None):
+        self.queue_url = queue_url or getenv('QUEUE_URL')
+        self.pending = []
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = aws.client('sqs')
+        return self._client
+
+    def publish(self, event_type, blog_id, author_id, post_id=None, **data):
+        event = make_event(event_type, blog_id, author_id, post_id, **data)
+        self.pending.append(event)
+        return event
+
+    # Sends everything pending, retrying entries SQS reports as failed on its side. Returns the
+    # events that could not be sent; they are also logged so they can be replayed. Never raises, the
+    # writes the events describe are already committed and the caller still gets its response.
+    def flush(self):
+        pending, self.pending = self.pending, []
+        failed = []
+        for start in range(0, len(pending), SEND_BATCH_SIZE):
+            failed.extend(self._send(pending[start:start + SEND_BATCH_SIZE]))
+        for event in failed:
+            print("event not published:", json.dumps(event, default=str))
+        return failed
+
+    # Sends `event` back to the queue now, unchanged, for work that continues in another invocation.
+    # Unlike flush() this raises when the event could not be sent, so the caller can fail the message
+    # it is working on and have SQS deliver that again instead.
+    def requeue(self, event):
+        if self._send([event]):
+            raise RuntimeError(f"could not requeue event {event.get('event_id')}")
+
+    def _send(self, events):
+        entries = {str(index): event for index, event in enumerate(events)}
+        rejected = []
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                result = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=[{
+                    "Id": entry_id,
+                    "MessageBody": json.dumps(event, default=str),
+                    "MessageAttributes": {"event_type": {"DataType": "String", "StringValue": event["event_type"]}}
+                } for entry_id, event in entries.items()])
+            except (BotoCoreError, ClientError) as err:
+                # throttling and network errors were already retried by the client itself
+                print("send failed:", repr(err))
+                return rejected + list(entries.values())
+            retryable = {failure["Id"] for failure in result.get("Failed", []) if not failure.get("SenderFault")}
+            rejected += [entries[failure["Id"]] for failure in result.get("Failed", []) if failure.get("SenderFault")]
+            entries = {entry_id: event for entry_id, event in entries.items() if entry_id in retryable}
+            if not entries:
+                return rejected
+            backoff(attempt)
+        return rejected + list(entries.values())
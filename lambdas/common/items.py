@@ -0,0 +1,98 @@
+from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Attr, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeDeserializer
+
+_deserializer = TypeDeserializer()
+
+
+# Timestamps are fixed width ISO 8601 UTC strings so they sort lexically in time order
+def timestamp(moment=None):
+    moment = moment or datetime.now(timezone.utc)
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+# Parses a client supplied time (any ISO 8601 form) into the stored format. Raises ValueError.
+def parse_timestamp(value):
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return timestamp(moment)
+
+
+# Reads an optional expected_version for optimistic concurrency. Raises ValueError.
+def parse_version(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool) or not str(value).isdigit():
+        raise ValueError("expected_version must be a non-negative integer")
+    return int(value)
+
+
+# Items that were never versioned count as version 0
+def version_condition(expected_version):
+    if expected_version == 0:
+        return Attr("version").not_exists()
+    return Attr("version").eq(expected_version)
+
+
+# update_item arguments that SET only the supplied fields, REMOVE `removals`, stamp updated_at and bump
+# the item's version in one round trip. `condition` guards existence and ownership; expected_version adds
+# an optimistic lock. On failure the old item comes back with the exception, see condition_failure().
+def versioned_update(changes, condition, expected_version=None, removals=()):
+    if expected_version is not None:
+        condition = condition & version_condition(expected_version)
+    fields = dict(changes, updated_at=timestamp())
+    expression = "SET " + ", ".join(f"#{name} = :{name}" for name in fields)
+    if removals:
+        expression += " REMOVE " + ", ".join(f"#{name}" for name in removals)
+    return {
+        "UpdateExpression": expression + " ADD #version :one",
+        "ConditionExpression": condition,
+        "ExpressionAttributeNames": dict({f"#{name}": name for name in list(fields) + list(removals)}, **{"#version": "version"}),
+        "ExpressionAttributeValues": dict({f":{name}": value for name, value in fields.items()}, **{":one": 1}),
+        "ReturnValues": "ALL_NEW",
+        "ReturnValuesOnConditionCheckFailure": "ALL_OLD"
+    }
+
+
+# A versioned_update() as the Update of a TransactWriteItems call. boto3 only turns condition objects
+# into expressions for top level arguments, so inside a transaction that is done here.
+def transaction_update(table, key, update):
+    condition, names, values = ConditionExpressionBuilder().build_expression(update["ConditionExpression"])
+    return {"Update": dict(
+        {name: value for name, value in update.items() if name != "ReturnValues"},
+        TableName=table.name,
+        Key=key,
+        ConditionExpression=condition,
+        ExpressionAttributeNames=dict(update["ExpressionAttributeNames"], **names),
+        ExpressionAttributeValues=dict(update["ExpressionAttributeValues"], **values)
+    )}
+
+
+# Works out why a conditional write failed from the old item DynamoDB returned with the error.
+# Returns (status code, message): 404 if the item is gone, 401 if the caller doesn't own it,
+# otherwise 409 because expected_version no longer matches. For a cancelled transaction `index`
+# is the position of the write that failed.
+def condition_failure(err, owner_attribute, user_id, index=None):
+    item = old_item(err, index)
+    if item is None:
+        return 404, "Not found"
+    if item.get(owner_attribute) != user_id:
+        return 401, "Unauthorized"
+    return 409, {"error": "Version conflict", "version": int(item.get("version", 0))}
+
+
+# The item as it was before a failed conditional write, None if it didn't exist
+def old_item(err, index=None):
+    if index is None:
+        old = err.response.get("Item")
+    else:
+        old = err.response.get("CancellationReasons", [])[index].get("Item")
+    if not old:
+        return None
+    return {name: _deserializer.deserialize(value) for name, value in old.items()}
+
+
+# The reason each write of a cancelled transaction gave, in order, e.g. "ConditionalCheckFailed" or "None"
+def cancellation_codes(err):
+    return [reason.get("Code") for reason in err.response.get("CancellationReasons", [])]
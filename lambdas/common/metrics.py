@@ -0,0 +1,221 @@
+import json
+import random
+import threading
+import time
+from functools import wraps
+from os import getenv
+
+# Per-request metrics in CloudWatch Embedded Metric Format: every invocation ends with one JSON log
+# line that CloudWatch turns into metrics with dimensions function and route, so nothing is sent
+# anywhere during the request. The AWS clients from common.aws report every call's duration, retries,
+# consumed capacity and item count into the request that made it.
+NAMESPACE = getenv('METRICS_NAMESPACE', 'BlogPro')
+# Requests slower than this also log each AWS call they made, for METRICS_SLOW_SAMPLE_RATE of them.
+# 0 turns the detail off.
+SLOW_REQUEST_MS = float(getenv('METRICS_SLOW_REQUEST_MS', '0'))
+SLOW_SAMPLE_RATE = float(getenv('METRICS_SLOW_SAMPLE_RATE', '1'))
+MAX_CALL_DETAILS = 50
+
+SERVICE_NAMES = {"dynamodb": "DynamoDB", "s3": "S3", "sqs": "SQS"}
+# Failed conditions are how optimistic locking and uniqueness checks answer, not errors
+CONDITION_FAILURES = frozenset(("ConditionalCheckFailedException", "TransactionCanceledException"))
+# DynamoDB operations that can report consumed capacity
+CAPACITY_OPERATIONS = frozenset(("GetItem", "PutItem", "UpdateItem", "DeleteItem", "Query", "Scan", "BatchGetItem",
+                                 "BatchWriteItem", "TransactGetItems", "TransactWriteItems"))
+
+_local = threading.local()
+
+
+def _print(record):
+    print(json.dumps(record, separators=(",", ":"), default=str))
+
+
+_sink = _print
+
+
+# Where finished records go, stdout by default. The benchmarks collect them in memory instead.
+def set_sink(sink):
+    global _sink
+    _sink = sink or _print
+
+
+class Request:
+    def __init__(self, function, route):
+        self.function = function
+        self.route = route
+        self.values = {}
+        self.calls = [] if SLOW_REQUEST_MS else None
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1, unit="Count"):
+        with self._lock:
+            if name in self.values:
+                self.values[name][0] += value
+            else:
+                self.values[name] = [value, unit]
+
+    def put(self, name, value, unit="None"):
+        with self._lock:
+            self.values[name] = [value, unit]
+
+    def record_call(self, service, operation, elapsed_ms, retries, capacity, items, error=None):
+        prefix = SERVICE_NAMES.get(service, service)
+        self.add(f"{prefix}Calls")
+        self.add(f"{prefix}Time", elapsed_ms, "Milliseconds")
+        if retries:
+            self.add(f"{prefix}Retries", retries)
+        if error in CONDITION_FAILURES:
+            self.add(f"{prefix}ConditionFailures")
+        elif error:
+            self.add(f"{prefix}Errors")
+        if service == "dynamodb":
+            self.add("DynamoDBCapacity", capacity, "None")
+            self.add("DynamoDBItems", items)
+            if operation == "Scan":
+                self.add("DynamoDBScans")
+        if self.calls is not None and len(self.calls) < MAX_CALL_DETAILS:
+            with self._lock:
+                self.calls.append({"service": service, "operation": operation, "ms": round(elapsed_ms, 2),
+                                   "retries": retries, "capacity": capacity, "items": items, "error": error})
+
+    def finish(self, status=None, failed=False):
+        elapsed_ms = (time.perf_counter() - self.started) * 1000
+        self.put("Duration", elapsed_ms, "Milliseconds")
+        self.put("Errors", int(failed or (status is not None and status >= 500)))
+        if status is not None:
+            self.put("ClientErrors", int(400 <= status < 500))
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["function", "route"], ["function"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in self.values.items()]
+                }]
+            },
+            "function": self.function,
+            "route": self.route,
+        }
+        record.update((name, value) for name, (value, _) in self.values.items())
+        if status is not None:
+            record["status"] = status
+        if self.calls is not None and elapsed_ms >= SLOW_REQUEST_MS and random.random() < SLOW_SAMPLE_RATE:
+            record["calls"] = self.calls
+        _sink(record)
+        return record
+
+
+# The request being handled on this thread, None outside of one
+def current():
+    return getattr(_local, "request", None)
+
+
+def add(name, value=1, unit="Count"):
+    request = current()
+    if request is not None:
+        request.add(name, value, unit)
+
+
+def put(name, value, unit="None"):
+    request = current()
+    if request is not None:
+        request.put(name, value, unit)
+
+
+# Wraps `fn` so that, run on a worker thread, its AWS calls still count towards this thread's request
+def bind(fn):
+    request = current()
+
+    @wraps(fn)
+    def bound(*args, **kwargs):
+        previous = current()
+        _local.request = request
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.request = previous
+    return bound
+
+
+# API Gateway requests by method and resource, everything else by what invoked the function
+def route(event):
+    if "httpMethod" in event:
+        return f"{event['httpMethod']} {event.get('resource') or event.get('path') or '/'}"
+    if "authorizationToken" in event:
+        return "authorize"
+    if "Records" in event:
+        return "queue"
+    return event.get("detail-type") or "invoke"
+
+
+# Decorates a lambda_handler: the invocation is timed and its record emitted however it ends
+def handler(function):
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(event, context):
+            request = Request(function, route(event))
+            _local.request = request
+            status = None
+            failed = True
+            try:
+                result = fn(event, context)
+                if isinstance(result, dict) and isinstance(result.get("statusCode"), int):
+                    status = result["statusCode"]
+                failed = False
+                return result
+            finally:
+                _local.request = None
+                request.finish(status, failed)
+        return wrapper
+    return decorate
+
+
+# Hooks a botocore client so each call is reported to the current request. DynamoDB calls also ask
+# for their consumed capacity, which costs nothing but a few bytes in the response.
+def instrument(client, service):
+    events = client.meta.events
+
+    def before_parameters(params, model, **kwargs):
+        if model.name in CAPACITY_OPERATIONS and current() is not None:
+            params.setdefault("ReturnConsumedCapacity", "TOTAL")
+
+    def before_call(model, context, **kwargs):
+        context["metrics_started"] = time.perf_counter()
+        context["metrics_operation"] = model.name
+
+    # error responses come through here too, with the error in the parsed body
+    def after_call(parsed, context, **kwargs):
+        _report(service, parsed, context, (parsed.get("Error") or {}).get("Code"))
+
+    # the request never got a response, e.g. a timeout after the last retry
+    def after_error(exception, context, **kwargs):
+        _report(service, {}, context, type(exception).__name__)
+
+    if service == "dynamodb":
+        events.register(f"before-parameter-build.{service}", before_parameters)
+    events.register(f"before-call.{service}", before_call)
+    events.register(f"after-call.{service}", after_call)
+    events.register(f"after-call-error.{service}", after_error)
+    return client
+
+
+def _report(service, parsed, context, error=None):
+    request = current()
+    started = context.get("metrics_started")
+    if request is None or started is None:
+        return
+    operation = context.get("metrics_operation")
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    retries = (parsed.get("ResponseMetadata") or {}).get("RetryAttempts", 0)
+    capacity = 0.0
+    consumed = parsed.get("ConsumedCapacity") or []
+    for entry in consumed if isinstance(consumed, list) else [consumed]:
+        capacity += float(entry.get("CapacityUnits", 0))
+    if "Count" in parsed:
+        items = parsed["Count"]
+    elif "Responses" in parsed:
+        items = sum(len(found) for found in parsed["Responses"].values())
+    else:
+        items = int("Item" in parsed)
+    request.record_call(service, operation, elapsed_ms, retries, capacity, items, error)
@@ -0,0 +1,98 @@
+import base64
+import binascii
+import json
+from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Lambda proxy responses are capped at 6 MB, leave headroom for headers and the JSON envelope
+MAX_PAGE_BYTES = 5 * 1024 * 1024
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+# Reads ?limit= and ?cursor= from the request. Raises ValueError if either is invalid, or if key_names
+# are given and the cursor isn't a key made of exactly those attributes.
+def get_page_params(event, key_names=None):
+    params = event.get("queryStringParameters") or {}
+
+    limit = params.get("limit")
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    else:
+        if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        limit = int(limit)
+
+    return limit, decode_cursor(params.get("cursor"), key_names)
+
+
+# Cursors are the DynamoDB key to resume from, in DynamoDB JSON so numbers survive the round trip,
+# then base64 encoded so clients treat them as opaque
+def encode_cursor(key):
+    if key is None:
+        return None
+    typed = {name: _serializer.serialize(value) for name, value in key.items()}
+    return base64.urlsafe_b64encode(json.dumps(typed, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, key_names=None):
+    if not cursor:
+        return None
+    try:
+        typed = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        key = {name: _deserializer.deserialize(value) for name, value in typed.items()}
+    except (binascii.Error, UnicodeError, ValueError, TypeError, AttributeError):
+        raise ValueError("invalid cursor")
+    if key_names is not None:
+        check_key(key, key_names)
+    return key
+
+
+# Cursors come back from clients, so the fields a handler reads from one are checked first.
+# A non-negative whole number from a cursor, raises ValueError for anything else.
+def cursor_int(value):
+    if isinstance(value, bool) or not isinstance(value, (int, Decimal)) or value < 0 or value % 1:
+        raise ValueError("invalid cursor")
+    return int(value)
+
+
+# A key read from a cursor must have exactly `key_names`, so it can be an ExclusiveStartKey. Key
+# attributes are non-empty strings, apart from the ones in number_names. Raises ValueError.
+def check_key(key, key_names, number_names=()):
+    if not isinstance(key, dict) or set(key) != set(key_names):
+        raise ValueError("invalid cursor")
+    for name, value in key.items():
+        if name in number_names:
+            cursor_int(value)
+        elif not isinstance(value, str) or value == "":
+            raise ValueError("invalid cursor")
+
+
+# Runs a Scan or Query (operation is e.g. table.scan) until `limit` items are collected or the
+# results run out, never holding more than one page of `max_bytes` of items. Returns the items
+# and the cursor for the next page, or None on the last page. key_names are the attributes that
+# make up the key of the table or index being read, used to resume after a page cut short by size.
+def paginate(operation, key_names, limit, start_key=None, max_bytes=MAX_PAGE_BYTES, **kwargs):
+    items = []
+    size = 0
+    while True:
+        request = dict(kwargs, Limit=limit - len(items))
+        if start_key is not None:
+            request["ExclusiveStartKey"] = start_key
+        page = operation(**request)
+
+        for item in page["Items"]:
+            item_size = len(json.dumps(item, default=str)) + 1
+            if items and size + item_size > max_bytes:
+                return items, encode_cursor({name: items[-1][name] for name in key_names})
+            items.append(item)
+            size += item_size
+
+        start_key = page.get("LastEvaluatedKey")
+        if start_key is None:
+            return items, None
+        if len(items) >= limit:
+            return items, encode_cursor(start_key)
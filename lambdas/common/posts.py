@@ -0,0 +1,20 @@
+from boto3.dynamodb.conditions import Key
+
+# BlogPost GSI on (blog_id, created_at), a blog's posts in the order they were written
+BLOG_POSTS_INDEX = 'blog-created-index'
+BLOG_POSTS_KEY = ["blog_id", "created_at", "Id"]
+
+
+# Query arguments for a blog's posts, newest first, optionally only those created after `since`
+# or only those created no later than `until`
+def blog_posts_query(blog_id, since=None, until=None):
+    condition = Key("blog_id").eq(blog_id)
+    if since is not None:
+        condition = condition & Key("created_at").gt(since)
+    elif until is not None:
+        condition = condition & Key("created_at").lte(until)
+    return {
+        "IndexName": BLOG_POSTS_INDEX,
+        "KeyConditionExpression": condition,
+        "ScanIndexForward": False
+    }
@@ -0,0 +1,58 @@
+import base64
+import json
+from decimal import Decimal
+from boto3.dynamodb.types import Binary
+
+# orjson is several times faster on big lists, the stdlib encoder is the fallback where it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# DynamoDB hands numbers back as Decimal and string/number sets as set, neither is JSON on its own
+def json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, Binary):
+        return base64.b64encode(value.value).decode("ascii")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            # integers beyond 64 bits, which only the stdlib encoder handles
+            pass
+    return json.dumps(value, default=json_default, separators=(",", ":"), ensure_ascii=False)
+
+
+# Error bodies are always {"error": message}; success bodies go out as they are
+def response(code, body, headers=None):
+    if code >= 400 and isinstance(body, str):
+        body = {"error": body}
+    return {
+        "statusCode": code,
+        "headers": dict({"Content-Type": "application/json"}, **(headers or {})),
+        "body": dumps(body),
+        "isBase64Encoded": False
+    }
+
+
+# Answer to a conditional GET whose ETag still matches, nothing is serialized
+def not_modified_response(headers):
+    return {"statusCode": 304, "headers": headers, "body": "", "isBase64Encoded": False}
+
+
+# The request's JSON body, None without one. API Gateway base64 encodes bodies whose content type
+# is one of the API's binary media types, if it ever has any.
+def request_body(event):
+    body = event.get("body")
+    if body is None:
+        return None
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body)
+    return json.loads(body)
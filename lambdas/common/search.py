@@ -0,0 +1,226 @@
+import math
+import re
+from collections import Counter
+from boto3.dynamodb.conditions import Attr, Key
+from common.batch import batch_write
+
+# Full-text search over posts and blogs, kept in the BlogSearch table (term, doc):
+#   - a posting per distinct term of a document: term "<kind>:<stem>", doc "<id>", with the term's
+#     frequency tf and the document's length dl
+#   - a title posting per title word for prefix matches: term "<kind>~<first letters>", doc "<word>#<id>"
+#   - a record of what was written for the document: term "#doc", doc "<kind>#<id>"
+#   - per kind the totals BM25 needs: term "#stats", doc "<kind>", with count and length
+# A query reads one posting list per query term, so it costs what those lists hold, not the corpus.
+SEARCH_KEY = ["term", "doc"]
+POST = "post"
+BLOG = "blog"
+DOC_TERM = "#doc"
+STATS_TERM = "#stats"
+
+# Title words count this many times towards a document's terms
+TITLE_WEIGHT = 2
+# A long post is indexed under its most frequent terms only, title terms are always kept
+MAX_DOC_TERMS = 500
+MAX_TERM_LENGTH = 40
+PREFIX_LENGTH = 2
+MAX_QUERY_TERMS = 8
+# Ranked results a query can page through
+MAX_SEARCH_RESULTS = 1000
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i if in into is it its of on or our she "
+    "so that the their them they this to was we were what when which who will with you your".split()
+)
+
+_WORD = re.compile(r"\w+")
+
+
+# Light suffix stripping in the spirit of Porter's first step: plurals, -ed, -ing and -ly. Index and
+# queries go through the same function, so "posting", "posted" and "posts" all meet at "post".
+def stem(word):
+    if len(word) <= 3 or word.isdigit():
+        return word
+    if word.endswith("sses"):
+        word = word[:-2]
+    elif word.endswith("ies") and len(word) > 4:
+        word = word[:-3] + "y"
+    elif word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        word = word[:-1]
+
+    for suffix in ("ingly", "edly", "ing", "ed", "ly"):
+        base = word[:-len(suffix)]
+        if word.endswith(suffix) and len(base) >= 3 and any(letter in "aeiouy" for letter in base):
+            word = base
+            if word.endswith(("at", "bl", "iz")):
+                word += "e"
+            elif len(word) > 3 and word[-1] == word[-2] and word[-1] not in "lsz":
+                word = word[:-1]
+            break
+    return word
+
+
+# Lowercased words of the text without stopwords, as typed
+def words(text):
+    return [word for word in _WORD.findall((text or "").lower())
+            if word not in STOPWORDS and len(word) <= MAX_TERM_LENGTH]
+
+
+def term_key(kind, term):
+    return f"{kind}:{term}"
+
+
+def prefix_key(kind, word):
+    return f"{kind}~{word[:PREFIX_LENGTH]}"
+
+
+def doc_key(kind, doc_id):
+    return f"{kind}#{doc_id}"
+
+
+# The postings a document should have, as {(term, doc): item}, and its length. Title words also
+# get prefix postings.
+def document_postings(kind, doc_id, title, body):
+    title_words = words(title)
+    counts = Counter()
+    for word in title_words:
+        counts[stem(word)] += TITLE_WEIGHT
+    counts.update(stem(word) for word in words(body))
+    length = sum(counts.values())
+
+    keep = {stem(word) for word in title_words}
+    for term, _ in counts.most_common():
+        if len(keep) >= MAX_DOC_TERMS:
+            break
+        keep.add(term)
+    postings = {}
+    for term in keep:
+        postings[(term_key(kind, term), doc_id)] = {"tf": counts[term], "dl": length}
+    for word, count in Counter(word for word in title_words if len(word) >= PREFIX_LENGTH).items():
+        postings[(prefix_key(kind, word), f"{word}#{doc_id}")] = {"tf": count * TITLE_WEIGHT, "dl": length}
+    return postings, length
+
+
+# Brings a document's postings in line with its current title and body. Postings are written before
+# the doc record that lists them, so a run that fails halfway is simply repeated; a version that is
+# already indexed is skipped. Raises if writes still fail after batch_write's retries.
+def index_document(table, kind, doc_id, title, body, version, workers=1):
+    record = table.get_item(Key={"term": DOC_TERM, "doc": doc_key(kind, doc_id)}, ConsistentRead=True).get("Item")
+    if record is not None and int(record.get("version", 0)) >= version:
+        return False
+
+    wanted, length = document_postings(kind, doc_id, title, body)
+    stale = {tuple(key) for key in (record or {}).get("keys", [])} - set(wanted)
+    requests = [{"PutRequest": {"Item": dict(item, term=term, doc=doc)}} for (term, doc), item in wanted.items()]
+    requests.extend({"DeleteRequest": {"Key": {"term": term, "doc": doc}}} for term, doc in stale)
+    if batch_write(table, requests, workers):
+        raise RuntimeError(f"search index writes failed for {kind} {doc_id}")
+
+    try:
+        table.put_item(
+            Item={"term": DOC_TERM, "doc": doc_key(kind, doc_id), "keys": [list(key) for key in wanted],
+                  "length": length, "version": version},
+            ConditionExpression=Attr("doc").not_exists() | Attr("version").lt(version)
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        # a newer version was indexed meanwhile, its own run wrote its postings
+        return False
+    _add_stats(table, kind, 0 if record else 1, length - int((record or {}).get("length", 0)))
+    return True
+
+
+# Removes everything written for a document, for one that was deleted
+def remove_document(table, kind, doc_id, workers=1):
+    record = table.get_item(Key={"term": DOC_TERM, "doc": doc_key(kind, doc_id)}, ConsistentRead=True).get("Item")
+    if record is None:
+        return False
+    requests = [{"DeleteRequest": {"Key": {"term": term, "doc": doc}}} for term, doc in record.get("keys", [])]
+    if batch_write(table, requests, workers):
+        raise RuntimeError(f"search index deletes failed for {kind} {doc_id}")
+    try:
+        table.delete_item(Key={"term": DOC_TERM, "doc": doc_key(kind, doc_id)}, ConditionExpression=Attr("doc").exists())
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    _add_stats(table, kind, -1, -int(record.get("length", 0)))
+    return True
+
+
+def _add_stats(table, kind, count, length):
+    table.update_item(
+        Key={"term": STATS_TERM, "doc": kind},
+        UpdateExpression="ADD #count :count, #length :length",
+        ExpressionAttributeNames={"#count": "count", "#length": "length"},
+        ExpressionAttributeValues={":count": count, ":length": length}
+    )
+
+
+# The query's terms: stems matched exactly, and the last word as typed, matched as a title prefix
+# unless the query ends in a space
+def query_terms(q):
+    typed = words(q)[:MAX_QUERY_TERMS]
+    terms = list(dict.fromkeys(stem(word) for word in typed))
+    prefix = typed[-1] if typed and not q[-1].isspace() and len(typed[-1]) >= PREFIX_LENGTH else None
+    return terms, prefix
+
+
+def bm25(tf, dl, df, count, average_length):
+    idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / (average_length or 1))
+    return idf * tf * (BM25_K1 + 1) / norm
+
+
+def postings(table, term, prefix=None):
+    kwargs = {"KeyConditionExpression": Key("term").eq(term)}
+    if prefix is not None:
+        kwargs["KeyConditionExpression"] &= Key("doc").begins_with(prefix)
+    while True:
+        page = table.query(**kwargs)
+        yield from page["Items"]
+        if "LastEvaluatedKey" not in page:
+            return
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+
+# {doc id: BM25 score} for the query over one kind. Every query term adds its score; the prefix word
+# adds the best score among the title words it starts, or its exact stem's score if that is higher.
+def score(table, kind, terms, prefix):
+    stats = table.get_item(Key={"term": STATS_TERM, "doc": kind}).get("Item") or {}
+    count = int(stats.get("count", 0))
+    if count <= 0:
+        return {}
+    average_length = float(stats.get("length", 0)) / count
+
+    def term_scores(items, doc_id=lambda item: item["doc"]):
+        items = list(items)
+        return {doc_id(item): bm25(int(item["tf"]), int(item["dl"]), len(items), count, average_length)
+                for item in items}
+
+    exact = {term: term_scores(postings(table, term_key(kind, term))) for term in terms}
+    scores = Counter()
+    last = stem(prefix) if prefix else None
+    for term, found in exact.items():
+        if term != last:
+            scores.update(found)
+    if prefix:
+        expanded = {}
+        for item in postings(table, prefix_key(kind, prefix), prefix):
+            word, doc_id = item["doc"].split("#", 1)
+            expanded.setdefault(word, []).append(dict(item, doc=doc_id))
+        best = dict(exact.get(last, {}))
+        for items in expanded.values():
+            for doc_id, value in term_scores(items).items():
+                best[doc_id] = max(best.get(doc_id, 0), value)
+        scores.update(best)
+    return scores
+
+
+# The [offset, offset + limit) slice of the ranking as (kind, id, score), and whether more follow
+def search(table, q, kinds=(POST, BLOG), offset=0, limit=10):
+    terms, prefix = query_terms(q)
+    if not terms:
+        return [], False
+    ranked = [(kind, doc_id, value) for kind in kinds for doc_id, value in score(table, kind, terms, prefix).items()]
+    ranked.sort(key=lambda result: (-result[2], result[0], result[1]))
+    ranked = ranked[:MAX_SEARCH_RESULTS]
+    return ranked[offset:offset + limit], offset + limit < len(ranked)
@@ -0,0 +1,65 @@
+from boto3.dynamodb.conditions import Key
+
+# BlogSubscription holds one item per (blog_id, user_id). The user-index GSI flips the key
+# so a user's followed blogs are a Query too.
+SUBSCRIPTION_KEY = ["blog_id", "user_id"]
+USER_INDEX = 'user-index'
+
+
+# Subscribes the user and bumps the blog's subscriber_count in one transaction. Returns True if the
+# subscription was created, False if it already existed, None if the blog doesn't exist or is being
+# deleted (a subscription written behind the cleanup would never be removed).
+def subscribe(subscription_table, blog_table, blog_id, user_id):
+    return _transact(subscription_table, [
+        {"Put": {
+            "TableName": subscription_table.name,
+            "Item": {"blog_id": blog_id, "user_id": user_id},
+            "ConditionExpression": "attribute_not_exists(blog_id)"
+        }},
+        _count_update(blog_table, blog_id, 1)
+    ])
+
+
+# The reverse of subscribe(): True if removed, False if the user wasn't subscribed, None if no blog
+def unsubscribe(subscription_table, blog_table, blog_id, user_id):
+    return _transact(subscription_table, [
+        {"Delete": {
+            "TableName": subscription_table.name,
+            "Key": {"blog_id": blog_id, "user_id": user_id},
+            "ConditionExpression": "attribute_exists(blog_id)"
+        }},
+        _count_update(blog_table, blog_id, -1)
+    ])
+
+
+def subscribers_query(blog_id):
+    return {"KeyConditionExpression": Key("blog_id").eq(blog_id)}
+
+
+def subscriptions_query(user_id):
+    return {"IndexName": USER_INDEX, "KeyConditionExpression": Key("user_id").eq(user_id)}
+
+
+def _count_update(blog_table, blog_id, delta):
+    condition = "attribute_exists(Id)" if delta < 0 else "attribute_exists(Id) AND attribute_not_exists(deletion_status)"
+    return {"Update": {
+        "TableName": blog_table.name,
+        "Key": {"Id": blog_id},
+        "UpdateExpression": "ADD subscriber_count :delta",
+        "ConditionExpression": condition,
+        "ExpressionAttributeValues": {":delta": delta}
+    }}
+
+
+def _transact(table, items):
+    client = table.meta.client
+    try:
+        client.transact_write_items(TransactItems=items)
+        return True
+    except client.exceptions.TransactionCanceledException as err:
+        reasons = [reason.get("Code") for reason in err.response.get("CancellationReasons", [])]
+        if len(reasons) == 2 and reasons[1] == "ConditionalCheckFailed":
+            return None
+        if len(reasons) == 2 and reasons[0] == "ConditionalCheckFailed":
+            return False
+        raise
@@ -0,0 +1,47 @@
+import time
+from boto3.dynamodb.conditions import Key
+
+# BlogTimeline holds every user's feed, one item per post from the blogs they follow, keyed by
+# (user_id, entry_key) with entry_key "<created_at>#<post_id>" so a Query returns them in time order.
+# The queue processor copies new posts into their followers' timelines. Blogs with more than
+# FANOUT_LIMIT subscribers are read at feed time instead, each follower's PULL_KEY item lists them.
+TIMELINE_KEY = ["user_id", "entry_key"]
+# sorts after every timestamp, so a newest-first Query of a timeline starts with it
+PULL_KEY = "pull"
+FANOUT_LIMIT = 5000
+FANOUT_READ = "read"
+# Timelines are capped by age, DynamoDB drops entries past expires_at, and by depth, the feed
+# stops paging after FEED_DEPTH entries
+TIMELINE_DAYS = 30
+FEED_DEPTH = 1000
+# Most recent posts copied into the timeline of someone who just subscribed
+BACKFILL_POSTS = 20
+# Fan-out-on-read blogs merged into one feed at most
+MAX_PULL_BLOGS = 25
+
+FEED_FIELDS = ("post_id", "blog_id", "author_id", "title", "created_at")
+
+
+def entry_key(created_at, post_id):
+    return f"{created_at}#{post_id}"
+
+
+def timeline_entry(user_id, post_id, blog_id, author_id, title, created_at, now=None):
+    return {
+        "user_id": user_id,
+        "entry_key": entry_key(created_at, post_id),
+        "post_id": post_id,
+        "blog_id": blog_id,
+        "author_id": author_id,
+        "title": title,
+        "created_at": created_at,
+        "expires_at": int(now or time.time()) + TIMELINE_DAYS * 24 * 3600
+    }
+
+
+# Query arguments for a timeline newest first, starting after `before` (an entry_key) when given
+def timeline_query(user_id, before=None):
+    condition = Key("user_id").eq(user_id)
+    if before is not None:
+        condition = condition & Key("entry_key").lt(before)
+    return {"KeyConditionExpression": condition, "ScanIndexForward": False}
@@ -0,0 +1,109 @@
+import base64
+import binascii
+import hmac
+from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+
+# BlogUser global secondary index keyed on username. Credential lookups query it
+# so their cost stays constant no matter how many users the table holds.
+USERNAME_INDEX = 'username-index'
+
+
+# Returns every user item with the given username (normally zero or one).
+def get_users_by_username(table, username):
+    try:
+        return _query_all(table, IndexName=USERNAME_INDEX, KeyConditionExpression=Key('username').eq(username))
+    except ClientError as err:
+        # The index is missing or still backfilling after the deploy that added it,
+        # fall back to a full paginated scan until it becomes ACTIVE.
+        if not _index_unavailable(err):
+            raise
+        return _scan_all(table, FilterExpression=Attr('username').eq(username))
+
+
+# Returns the user item matching the auth credentials, or None if they don't match exactly one user
+def get_user_by_credentials(table, username, password):
+    matches = [user for user in get_users_by_username(table, username)
+               if hmac.compare_digest(str(user.get('password', '')), password)]
+    if len(matches) == 1:
+        return matches[0]
+    return None
+
+
+# Grabs the user's guid with their auth credentials
+def get_user_by_username_password(table, username, password):
+    user = get_user_by_credentials(table, username, password)
+    return user['Id'] if user is not None else None
+
+
+# Returns the caller's guid. Requests routed through the API Gateway authorizer already carry it
+# in the request context, so the credentials are only looked up again when that is missing.
+def get_current_user_id(event, table):
+    authorizer = (event.get('requestContext') or {}).get('authorizer') or {}
+    if authorizer.get('user_id'):
+        return authorizer['user_id']
+
+    credentials = decode_basic_auth((event.get('headers') or {}).get('Authorization'))
+    if credentials is None:
+        return None
+    return get_user_by_username_password(table, *credentials)
+
+
+# Splits a "Basic <base64 username:password>" header, returns None if it is missing or malformed
+def decode_basic_auth(header):
+    if not header or not header.startswith('Basic '):
+        return None
+    try:
+        decoded = base64.b64decode(header[6:]).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    if ':' not in decoded:
+        return None
+    username, password = decoded.split(':', 1)
+    return username, password
+
+
+# BlogUsername holds one claim item per username that is taken. Signups and renames write the
+# claim in the same transaction as the user item, so of two requests for one name only one can win.
+def claim_username(username_table, username, user_id):
+    return {"Put": {
+        "TableName": username_table.name,
+        "Item": {"username": username, "user_id": user_id},
+        "ConditionExpression": "attribute_not_exists(username)"
+    }}
+
+
+# The transaction write that gives the name up again, it fails if the claim isn't user_id's
+def release_username(username_table, username, user_id):
+    return {"Delete": {
+        "TableName": username_table.name,
+        "Key": {"username": username},
+        "ConditionExpression": "user_id = :user_id",
+        "ExpressionAttributeValues": {":user_id": user_id}
+    }}
+
+
+def _query_all(table, **kwargs):
+    items = []
+    while True:
+        page = table.query(**kwargs)
+        items.extend(page['Items'])
+        if 'LastEvaluatedKey' not in page:
+            return items
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def _scan_all(table, **kwargs):
+    items = []
+    while True:
+        page = table.scan(**kwargs)
+        items.extend(page['Items'])
+        if 'LastEvaluatedKey' not in page:
+            return items
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def _index_unavailable(err):
+    error = err.response.get('Error', {})
+    return (error.get('Code') in ('ValidationException', 'ResourceNotFoundException')
+            and 'index' in error.get('Message', '').lower())
@@ -0,0 +1,116 @@
+import io
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+from os import getenv
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from common import aws, metrics
+from common.archive import COMPACTED_PREFIX, RAW_PREFIX, S3RangeReader, arrow_schema, object_key, partition_hour
+from common.archive import partition_prefix, read_raw, to_row
+
+bucket_name = getenv('BUCKET_NAME')
+s3_client = aws.client('s3')
+
+# An hour is compacted once it has been over this long, batches handled late in the hour may still
+# be on their way until then
+SETTLE_MINUTES = int(getenv('COMPACTION_SETTLE_MINUTES', 15))
+ROW_GROUP_SIZE = 50000
+READ_WORKERS = 16
+DELETE_BATCH_SIZE = 1000
+# Stops starting new partitions this close to the timeout, the next run carries on with them
+TIME_RESERVE_MS = 60000
+
+
+# Runs on a schedule. Every settled hour that still has raw batch objects is merged into one
+# Parquet file, the raw objects are deleted once the file reads back with all their rows.
+@metrics.handler('compactor')
+def lambda_handler(event, context):
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=1, minutes=SETTLE_MINUTES)
+    results = []
+    for hour in raw_partitions(bucket_name):
+        if hour > cutoff:
+            break
+        if time_left_ms(context) < TIME_RESERVE_MS:
+            break
+        results.append(compact_partition(bucket_name, hour))
+
+    print("compaction:", json.dumps(results))
+    return results
+
+
+# Hours that have raw objects, oldest first
+def raw_partitions(bucket):
+    hours = []
+    for day in list_prefixes(bucket, f"{RAW_PREFIX}/"):
+        hours.extend(partition_hour(prefix) for prefix in list_prefixes(bucket, day))
+    return sorted(hour for hour in hours if hour is not None)
+
+
+def compact_partition(bucket, hour):
+    raw_keys = list_keys(bucket, partition_prefix(RAW_PREFIX, hour))
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+        payloads = list(pool.map(metrics.bind(lambda key: s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()), raw_keys))
+
+    # SQS can deliver a message twice, and a run that stopped between writing its file and deleting
+    # the originals has already compacted some of them, so rows are keyed by message id
+    done = compacted_message_ids(bucket, hour)
+    rows = {}
+    for payload in payloads:
+        for record in read_raw(payload):
+            if record["message_id"] not in done:
+                rows[record["message_id"]] = to_row(record)
+
+    key = None
+    if rows:
+        # sorted so the row group statistics of event_type and blog_id are narrow enough to skip on
+        rows = sorted(rows.values(), key=lambda row: (row["event_type"] or "", row["blog_id"] or "", row["occurred_at"]))
+        buffer = io.BytesIO()
+        pq.write_table(pa.Table.from_pylist(rows, schema=arrow_schema()), buffer,
+                       row_group_size=ROW_GROUP_SIZE, compression="zstd")
+        key = object_key(COMPACTED_PREFIX, hour, "parquet")
+        s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+
+        stored_rows = pq.ParquetFile(S3RangeReader(s3_client, bucket, key)).metadata.num_rows
+        if stored_rows != len(rows):
+            raise RuntimeError(f"{key} holds {stored_rows} rows, expected {len(rows)}")
+
+    delete_objects(bucket, raw_keys)
+    return {"partition": partition_prefix(RAW_PREFIX, hour), "objects": len(raw_keys), "rows": len(rows), "key": key}
+
+
+def compacted_message_ids(bucket, hour):
+    ids = set()
+    for key in list_keys(bucket, partition_prefix(COMPACTED_PREFIX, hour)):
+        ids.update(pq.read_table(S3RangeReader(s3_client, bucket, key), columns=["message_id"])["message_id"].to_pylist())
+    return ids
+
+
+def list_prefixes(bucket, prefix):
+    prefixes = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        prefixes.extend(entry["Prefix"] for entry in page.get("CommonPrefixes", []))
+    return prefixes
+
+
+def list_keys(bucket, prefix):
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(entry["Key"] for entry in page.get("Contents", []))
+    return keys
+
+
+def delete_objects(bucket, keys):
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        result = s3_client.delete_objects(Bucket=bucket, Delete={
+            "Objects": [{"Key": key} for key in keys[start:start + DELETE_BATCH_SIZE]], "Quiet": True
+        })
+        if result.get("Errors"):
+            # what's left is picked up again by the next run, its rows are skipped as already compacted
+            print("delete failed:", json.dumps(result["Errors"]))
+
+
+def time_left_ms(context):
+    if context is None:
+        return float("inf")
+    return context.get_remaining_time_in_millis()
@@ -1,34 +1,82 @@
-import boto3
-import base64
 from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.conditions import Attr
 from os import getenv
 from uuid import uuid4
-import json
-from datetime import datetime
-
-client = boto3.client('sqs')
-queue_url = getenv('QUEUE_URL')
-
-
-region_name = getenv('APP_REGION')
-blog_post_table = boto3.resource('dynamodb', region_name=region_name).Table('BlogPost')
-blog_blog_table = boto3.resource('dynamodb', region_name=region_name).Table('BlogBlog')
-blog_user_table = boto3.resource('dynamodb', region_name=region_name).Table('BlogUser')
+from common import aws, events, metrics
+from common.batch import batch_get, batch_write
+from common.cache import TTLCache
+from common.conditional import conflict_status, expected_version, not_modified, validators
+from common.content import discard_content, needs_offload, read_content, stale_content_attributes, store_content, summary_projection
+from common.items import condition_failure, old_item, timestamp, version_condition, versioned_update
+from common.pagination import cursor_int, encode_cursor, get_page_params
+from common.posts import blog_posts_query
+from common.responses import not_modified_response, request_body, response
+from common.search import BLOG, POST, search
+from common.timeline import FEED_DEPTH, FEED_FIELDS, MAX_PULL_BLOGS, PULL_KEY, entry_key, timeline_query
+from common.users import get_current_user_id
+
+# events are buffered while handling a request and sent together once it is done
+publisher = events.EventPublisher()
+
+# long post content is kept in S3, see common/content.py
+bucket_name = getenv('BUCKET_NAME')
+s3_client = aws.client('s3')
+
+blog_post_table = aws.table('BlogPost')
+blog_blog_table = aws.table('BlogBlog')
+blog_user_table = aws.table('BlogUser')
+blog_timeline_table = aws.table('BlogTimeline')
+blog_search_table = aws.table('BlogSearch')
+
+# GET /post/batch?ids= accepts at most this many ids per call
+MAX_BATCH_IDS = 500
+# POST /post/batch creates at most this many posts per call, their content uploads run one after another
+MAX_BATCH_POSTS = 25
+# Presigned URLs for ?include=content_url stay valid this long
+CONTENT_URL_TTL = 300
+
+# GET /post/{id} reads through a per-container cache. This container's own writes invalidate their post,
+# POST_CACHE_TTL bounds how long another container's edit can go unseen. POST_CACHE_STALE > 0 keeps
+# serving an expired post for that long while it is reloaded in the background.
+POST_CACHE_SIZE = int(getenv('POST_CACHE_SIZE', '512'))
+POST_CACHE_TTL = float(getenv('POST_CACHE_TTL', '5'))
+POST_CACHE_STALE = float(getenv('POST_CACHE_STALE', '0'))
+
+post_cache = TTLCache(POST_CACHE_SIZE, stale=POST_CACHE_STALE, name="Post")
+
+
+@metrics.handler('post')
+def lambda_handler(event, context):
+    try:
+        return handle_request(event, context)
+    finally:
+        publisher.flush()
 
 
-def lambda_handler(event, context):
+def handle_request(event, context):
     http_method = event["httpMethod"]
 
-    # grab the auth header and decode it
-    auth_header = event["headers"]["Authorization"]
-    if not auth_header:
+    # the authorizer hands us the caller's guid, the credentials are only checked again without it
+    current_user_id = get_current_user_id(event, blog_user_table)
+    if current_user_id is None:
         return response(401, "Unauthorized")
-    encoded_credentials = auth_header.split(' ')[1]
-    decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
 
-    current_user_id = get_user_by_username_password(decoded_credentials.split(":")[0],
-                                                    decoded_credentials.split(":")[1])
+    if event.get("resource") == "/feed":
+        if http_method == "GET":
+            return get_feed(event, context, current_user_id)
+        return response(400, "invalid http method")
+
+    if event.get("resource") == "/search":
+        if http_method == "GET":
+            return search_content(event, context)
+        return response(400, "invalid http method")
+
+    if event.get("resource") == "/post/batch":
+        if http_method == "POST":
+            return create_posts(event, context, current_user_id)
+        if http_method == "GET":
+            return get_posts(event, context)
+        return response(400, "invalid http method")
 
     if http_method == "POST":
         return create_post(event, context, current_user_id)
@@ -44,7 +92,7 @@ def lambda_handler(event, context):
 
 def create_post(event, context, user_id):
     if "body" in event and event["body"] is not None:
-        body = json.loads(event["body"])
+        body = request_body(event)
 
     # grab the blog_id from the path parameters
     blog_id = body["blog_id"]
@@ -58,26 +106,228 @@ def create_post(event, context, user_id):
     if blog["Item"]["author"] != user_id:
         return response(401, "Unauthorized")
 
+    if "deletion_status" in blog["Item"]:
+        return response(409, "Blog is being deleted")
+
     post_id = str(uuid4())
     title = body["title"]
     content = body["content"]
+    created_at = timestamp()
+
+    fields = store_content(s3_client, bucket_name, blog_id, post_id, content)
+    try:
+        blog_post_table.put_item(Item={
+            "Id": post_id,
+            "blog_id": blog_id,
+            # stored so edits and deletes can check ownership in the write's own condition
+            "author_id": user_id,
+            "title": title,
+            **fields,
+            "created_at": created_at,
+            "version": 1
+        })
+    except Exception:
+        discard_content(s3_client, bucket_name, fields)
+        raise
+    publisher.publish(events.POST_CREATED, blog_id, user_id, post_id, title=title, created_at=created_at)
 
-    blog_post_table.put_item(Item={
-        "Id": post_id,
-        "blog_id": blog_id,
-        # "user_id": user_id,
-        "title": title,
-        "content": content
+    return response(200, {"post_id": post_id, "message": "Post successfully created!"})
+
+
+# POST /post/batch with {"posts": [{"blog_id", "title", "content"}, ...]}. The blogs are checked with one
+# BatchGetItem and the posts written with BatchWriteItem, the result reports every post by its index.
+def create_posts(event, context, user_id):
+    body = request_body(event) or {}
+    if not isinstance(body, dict):
+        return response(400, {"error": "Body must be a JSON object"})
+    entries = body.get("posts")
+    if not isinstance(entries, list) or not entries:
+        return response(400, {"error": "posts must be a non-empty list"})
+    if len(entries) > MAX_BATCH_POSTS:
+        return response(400, {"error": f"at most {MAX_BATCH_POSTS} posts per request"})
+
+    results = [None] * len(entries)
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not all(isinstance(entry.get(name), str) and entry[name] != ""
+                                                  for name in ("blog_id", "title", "content")):
+            results[index] = {"index": index, "error": "blog_id, title and content are required"}
+
+    # one lookup for all the distinct blogs instead of a get_item per post
+    blog_ids = sorted({entry["blog_id"] for index, entry in enumerate(entries) if results[index] is None})
+    blogs, unchecked = batch_get(blog_blog_table, [{"Id": blog_id} for blog_id in blog_ids],
+                                 ProjectionExpression="#id, author, deletion_status", ExpressionAttributeNames={"#id": "Id"})
+    authors = {blog["Id"]: blog["author"] for blog in blogs}
+    deleting = {blog["Id"] for blog in blogs if "deletion_status" in blog}
+    unchecked = {key["Id"] for key in unchecked}
+
+    # content is uploaded before the batch is written, if that never happens nothing would point at it
+    writes = []
+    try:
+        for index, entry in enumerate(entries):
+            if results[index] is not None:
+                continue
+            if entry["blog_id"] in unchecked:
+                results[index] = {"index": index, "error": "Blog could not be checked, retry"}
+            elif entry["blog_id"] not in authors:
+                results[index] = {"index": index, "error": "Blog not found"}
+            elif authors[entry["blog_id"]] != user_id:
+                results[index] = {"index": index, "error": "Unauthorized"}
+            elif entry["blog_id"] in deleting:
+                results[index] = {"index": index, "error": "Blog is being deleted"}
+            else:
+                post_id = str(uuid4())
+                writes.append({"PutRequest": {"Item": {
+                    "Id": post_id,
+                    "blog_id": entry["blog_id"],
+                    "author_id": user_id,
+                    "title": entry["title"],
+                    **store_content(s3_client, bucket_name, entry["blog_id"], post_id, entry["content"]),
+                    "created_at": timestamp(),
+                    "version": 1
+                }}})
+                results[index] = {"index": index, "post_id": post_id}
+    except Exception:
+        for request in writes:
+            discard_content(s3_client, bucket_name, request["PutRequest"]["Item"])
+        raise
+
+    try:
+        failed = {request["PutRequest"]["Item"]["Id"] for request in batch_write(blog_post_table, writes)}
+    except Exception:
+        # a retry can fail after an earlier call already wrote some of the posts, those keep their content
+        keys = [{"Id": request["PutRequest"]["Item"]["Id"]} for request in writes]
+        written, unknown = batch_get(blog_post_table, keys, ProjectionExpression="#id", ExpressionAttributeNames={"#id": "Id"})
+        kept = {post["Id"] for post in written} | {key["Id"] for key in unknown}
+        for request in writes:
+            if request["PutRequest"]["Item"]["Id"] not in kept:
+                discard_content(s3_client, bucket_name, request["PutRequest"]["Item"])
+        raise
+
+    for request in writes:
+        if request["PutRequest"]["Item"]["Id"] in failed:
+            discard_content(s3_client, bucket_name, request["PutRequest"]["Item"])
+    for result in results:
+        if result.get("post_id") in failed:
+            result["error"] = "Write failed, retry"
+            del result["post_id"]
+
+    for request in writes:
+        post = request["PutRequest"]["Item"]
+        if post["Id"] not in failed:
+            publisher.publish(events.POST_CREATED, post["blog_id"], user_id, post["Id"],
+                              title=post["title"], created_at=post["created_at"])
+
+    created = sum(1 for result in results if "post_id" in result)
+    return response(200, {"created": created, "failed": len(results) - created, "results": results})
+
+
+# GET /post/batch?ids=a,b,c returns every post found with BatchGetItem, without content, plus the ids
+# that don't exist and the ids DynamoDB couldn't serve even after retrying
+def get_posts(event, context):
+    ids = (event.get("queryStringParameters") or {}).get("ids") or ""
+    post_ids = list(dict.fromkeys(post_id for post_id in ids.split(",") if post_id))
+    if not post_ids:
+        return response(400, {"error": "ids is required"})
+    if len(post_ids) > MAX_BATCH_IDS:
+        return response(400, {"error": f"at most {MAX_BATCH_IDS} ids per request"})
+
+    posts, unprocessed = batch_get(blog_post_table, [{"Id": post_id} for post_id in post_ids], **summary_projection())
+    found = {post["Id"] for post in posts}
+    failed = {key["Id"] for key in unprocessed}
+    return response(200, {
+        "items": posts,
+        "missing": [post_id for post_id in post_ids if post_id not in found and post_id not in failed],
+        "failed": [post_id for post_id in post_ids if post_id in failed]
     })
 
-    print("QueueURL: ", queue_url)
-    date_time = datetime.now()
-    message = client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=("This was sent onnnn: " + str(date_time.strftime('%Y-%m-%d %H:%M:%S') + 'by alex'))
-        )
 
-    return response(200, {"post_id": post_id, "message": "Post successfully created!"})
+# What search results show of a blog
+BLOG_SUMMARY_FIELDS = ("Id", "title", "category", "description", "author", "subscriber_count", "deletion_status")
+
+
+# GET /search?q= ranks posts and blogs by BM25 over the inverted index the queue processor keeps,
+# ?type=post or ?type=blog searches just one of them. The last word of q also matches the start of title
+# words. Results whose item is gone by now are left out, so a page can come back short.
+def search_content(event, context):
+    params = event.get("queryStringParameters") or {}
+    q = params.get("q") or ""
+    if not q.strip():
+        return response(400, {"error": "q is required"})
+    kinds = {"post": (POST,), "blog": (BLOG,), None: (POST, BLOG)}.get(params.get("type"))
+    if kinds is None:
+        return response(400, {"error": "type must be post or blog"})
+    try:
+        limit, cursor = get_page_params(event)
+        offset = cursor_int(cursor.get("offset")) if cursor else 0
+    except ValueError as err:
+        return response(400, {"error": str(err)})
+
+    results, more = search(blog_search_table, q, kinds, offset, limit)
+
+    found = {}
+    post_ids = [doc_id for kind, doc_id, _ in results if kind == POST]
+    if post_ids:
+        posts, _ = batch_get(blog_post_table, [{"Id": post_id} for post_id in post_ids], **summary_projection())
+        found.update(((POST, post["Id"]), post) for post in posts)
+    blog_ids = [doc_id for kind, doc_id, _ in results if kind == BLOG]
+    if blog_ids:
+        blogs, _ = batch_get(blog_blog_table, [{"Id": blog_id} for blog_id in blog_ids],
+                             ProjectionExpression=", ".join(f"#{name}" for name in BLOG_SUMMARY_FIELDS),
+                             ExpressionAttributeNames={f"#{name}": name for name in BLOG_SUMMARY_FIELDS})
+        found.update(((BLOG, blog["Id"]), blog) for blog in blogs if "deletion_status" not in blog)
+
+    items = [{"type": kind, "id": doc_id, "score": round(score, 4), "item": found[(kind, doc_id)]}
+             for kind, doc_id, score in results if (kind, doc_id) in found]
+    next_cursor = encode_cursor({"offset": offset + limit}) if more else None
+    return response(200, {"items": items, "next_cursor": next_cursor})
+
+
+# GET /feed, the newest posts from the blogs the caller follows. Posts copied into the caller's
+# timeline come from one Query; blogs too popular to copy are listed in the timeline's pull item
+# and their newest posts are merged in from the blog's own index.
+def get_feed(event, context, user_id):
+    try:
+        limit, cursor = get_page_params(event)
+        if cursor:
+            before, pull, depth = cursor.get("before"), cursor.get("pull"), cursor_int(cursor.get("depth"))
+            if not isinstance(before, str) or not isinstance(pull, list) or len(pull) > MAX_PULL_BLOGS or \
+                    not all(isinstance(blog_id, str) and blog_id for blog_id in pull):
+                raise ValueError("invalid cursor")
+    except ValueError as err:
+        return response(400, {"error": str(err)})
+
+    before = cursor["before"] if cursor else None
+    # the first page also reads the pull item, which comes first, later pages carry it in the cursor
+    timeline = blog_timeline_table.query(Limit=limit + (1 if cursor else 2), **timeline_query(user_id, before))["Items"]
+    if not cursor:
+        pull, depth = [], 0
+        if timeline and timeline[0]["entry_key"] == PULL_KEY:
+            pull = sorted(timeline.pop(0).get("blog_ids", []))[:MAX_PULL_BLOGS]
+    more = len(timeline) > limit
+
+    # a blog switched to fan-out-on-read keeps the posts already copied into timelines, they come
+    # from the blog's index below like the rest of its posts
+    entries = [{name: entry[name] for name in FEED_FIELDS} for entry in timeline[:limit] if entry["blog_id"] not in pull]
+    for blog_id in pull:
+        until = before.split("#")[0] if before else None
+        posts = blog_post_table.query(
+            Limit=limit + 1, ProjectionExpression="Id, blog_id, author_id, title, created_at",
+            **blog_posts_query(blog_id, until=until)
+        )["Items"]
+        posts = [post for post in posts if before is None or entry_key(post["created_at"], post["Id"]) < before]
+        more = more or len(posts) > limit
+        entries.extend(dict({name: post.get(name) for name in FEED_FIELDS}, post_id=post["Id"]) for post in posts[:limit])
+
+    entries.sort(key=lambda entry: entry_key(entry["created_at"], entry["post_id"]), reverse=True)
+    more = more or len(entries) > limit
+    entries = entries[:limit]
+    depth += len(entries)
+
+    next_cursor = None
+    if more and entries and depth < FEED_DEPTH:
+        last = entries[-1]
+        next_cursor = encode_cursor({"before": entry_key(last["created_at"], last["post_id"]), "pull": pull, "depth": depth})
+    return response(200, {"items": entries, "next_cursor": next_cursor})
 
 
 def get_post(event, context):
@@ -91,43 +341,95 @@ def get_post(event, context):
 
     post_id = path["id"]
 
-    post = blog_post_table.get_item(Key={"Id": post_id})["Item"]
+    # the content only comes back on request: ?include=content, optionally with ?offset= and ?length=
+    # in characters, or ?include=content_url for a short lived link that streams it straight from S3
+    params = event.get("queryStringParameters") or {}
+    include = set((params.get("include") or "").split(","))
+    try:
+        offset = int(params.get("offset") or 0)
+        length = int(params["length"]) if params.get("length") else None
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError
+    except ValueError:
+        return response(400, {"error": "offset and length must be non-negative integers"})
+
+    post = post_cache.get_or_load(post_id, lambda: (blog_post_table.get_item(Key={"Id": post_id}).get("Item"), POST_CACHE_TTL))
+    if post is None:
+        return response(404, "Post not found")
+    # the cached item is shared between requests, this one gets its own copy to trim
+    post = dict(post)
+
+    # polling clients send back the ETag they have, an unchanged post costs them no body at all. The
+    # summary, the content and each range of it are separate representations with their own tags.
+    variants = []
+    if "content" in include:
+        variants.append(f"content.{offset}.{'' if length is None else length}")
+    if "content_url" in include:
+        variants.append("content_url")
+    headers = validators(post, variant=".".join(variants))
+    # a content_url is only valid for a while, a cached one is never confirmed
+    if "content_url" not in include and not_modified(event, headers["ETag"]):
+        return not_modified_response(headers)
+
+    if "content" in include:
+        post["content"] = read_content(s3_client, bucket_name, post, offset, length)
+        post["content_offset"] = offset
+    else:
+        post.pop("content", None)
+    if "content_url" in include and "content_key" in post:
+        post["content_url"] = s3_client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket_name, "Key": post["content_key"]}, ExpiresIn=CONTENT_URL_TTL)
+    post.pop("content_key", None)
 
-    return response(200, post)
+    return response(200, post, headers)
 
 
 def update_post(event, context, user_id):
     if "body" in event and event["body"] is not None:
-        body = json.loads(event["body"])
+        body = request_body(event)
 
-    post_id = body["post_id"]
+    post_id = body.get("post_id")
     if post_id is None:
         return response(404, "Post_id not found")
 
-    # check if the post_id exists
-    post = blog_post_table.get_item(Key={"Id": post_id})["Item"]
-    if post is None:
-        return response(400, "Post not found")
-
-    # grab the blog_id from the post
-    blog_id = post["blog_id"]
-
-    # check if the user is the author of the blog
-    blog = blog_blog_table.get_item(Key={"Id": blog_id})
-    if blog["Item"]["author"] != user_id:
-        return response(401, "Unauthorized")
-
-    title = body["title"]
-    content = body["content"]
-
-    if title != "":
-        post['title'] = title
-    if content != "":
-        post['content'] = content
-
-    blog_post_table.put_item(Item=post)
-
-    return response(200, post)
+    try:
+        version, if_match = expected_version(event, body.get("expected_version"))
+    except ValueError as err:
+        return response(400, {"error": str(err)})
+
+    # only the supplied fields are written, existence and authorship are checked by the update itself
+    changes = {name: body[name] for name in ("title", "content") if body.get(name, "") != ""}
+    updated_fields = sorted(changes)
+    removals = ()
+    if "content" in changes:
+        content = changes.pop("content")
+        blog_id = None
+        if needs_offload(content):
+            # offloaded content is filed under its blog, which the update itself doesn't know. Only the
+            # author gets as far as the upload, the update's condition still decides the rest.
+            current = blog_post_table.get_item(Key={"Id": post_id}, ProjectionExpression="blog_id, author_id").get("Item")
+            if current is None:
+                return response(404, "Not found")
+            if current.get("author_id") != user_id:
+                return response(401, "Unauthorized")
+            blog_id = current["blog_id"]
+        changes.update(store_content(s3_client, bucket_name, blog_id, post_id, content))
+        removals = stale_content_attributes(changes)
+    try:
+        post = blog_post_table.update_item(
+            Key={"Id": post_id},
+            **versioned_update(changes, Attr("Id").exists() & Attr("author_id").eq(user_id), version, removals)
+        )["Attributes"]
+    except blog_post_table.meta.client.exceptions.ConditionalCheckFailedException as err:
+        discard_content(s3_client, bucket_name, changes, old_item(err))
+        code, message = condition_failure(err, "author_id", user_id)
+        return response(conflict_status(code, if_match), message)
+    post_cache.invalidate(post_id)
+    post.pop("content_key", None)
+
+    publisher.publish(events.POST_UPDATED, post["blog_id"], user_id, post_id,
+                      fields=updated_fields, version=post["version"])
+    return response(200, post, validators(post))
 
 
 def delete_post(event, context, user_id):
@@ -141,41 +443,27 @@ def delete_post(event, context, user_id):
 
     post_id = path["id"]
 
-    # check if the post_id exists
-    post = blog_post_table.get_item(Key={"Id": post_id})["Item"]
-    if post is None:
-        return response(400, "Post not found")
-
-    # grab the blog_id from the post
-    blog_id = post["blog_id"]
-
-    # check if the user is the author of the blog
-    blog = blog_blog_table.get_item(Key={"Id": blog_id})
-    if blog["Item"]["author"] != user_id:
-        return response(401, "Unauthorized")
-
-    output = blog_post_table.delete_item(Key={"Id": post_id})
-
+    try:
+        version, if_match = expected_version(event, (event.get("queryStringParameters") or {}).get("expected_version"))
+    except ValueError as err:
+        return response(400, {"error": str(err)})
+
+    condition = Attr("Id").exists() & Attr("author_id").eq(user_id)
+    if version is not None:
+        condition = condition & version_condition(version)
+    try:
+        output = blog_post_table.delete_item(
+            Key={"Id": post_id},
+            ConditionExpression=condition,
+            ReturnValues="ALL_OLD",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD"
+        )
+    except blog_post_table.meta.client.exceptions.ConditionalCheckFailedException as err:
+        code, message = condition_failure(err, "author_id", user_id)
+        return response(conflict_status(code, if_match), message)
+    post_cache.invalidate(post_id)
+
+    # the old item is only needed for the event, the response stays as it was
+    post = output.pop("Attributes")
+    publisher.publish(events.POST_DELETED, post["blog_id"], user_id, post_id, created_at=post.get("created_at"))
     return response(200, output)
-
-
-def get_user_by_username_password(username, password):
-    # find the user in the table
-    user = blog_user_table.scan(FilterExpression=Attr('username').eq(username) & Attr('password').eq(password))
-    # if the user is found, return their guid
-    if len(user["Items"]) == 1:
-        return user["Items"][0]["Id"]
-    # if the user is not found, return None
-    else:
-        return None
-
-
-def response(code, body):
-    return {
-        "statusCode": code,
-        "headers": {
-            "Content-Type": "application/json"
-        },
-        "body": json.dumps(body),
-        "isBase64Encoded": False
-    }
@@ -1,37 +1,441 @@
+import gzip
 import json
-import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from concurrent.futures import ThreadPoolExecutor
 from os import getenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from common import aws, events, metrics
+from common.archive import RAW_PREFIX, object_key
+from common.batch import batch_write
+from common.blogs import LOOKUP_INDEXES, blog_post_keys, blog_subscription_keys, delete_keys, deletion_update
+from common.content import content_prefix, read_content
+from common.posts import blog_posts_query
+from common.search import BLOG, POST, index_document, remove_document
+from common.subscriptions import subscribers_query, subscriptions_query, unsubscribe
+from common.timeline import BACKFILL_POSTS, FANOUT_LIMIT, FANOUT_READ, PULL_KEY, entry_key, timeline_entry
 
 bucket_name = getenv('BUCKET_NAME')
-s3_client = boto3.client('s3')
+queue_url = getenv('QUEUE_URL')
+s3_client = aws.client('s3')
+publisher = events.EventPublisher(queue_url)
 
+blog_blog_table = aws.table('BlogBlog')
+blog_post_table = aws.table('BlogPost')
+blog_subscription_table = aws.table('BlogSubscription')
+blog_timeline_table = aws.table('BlogTimeline')
+blog_search_table = aws.table('BlogSearch')
 
+# Keys deleted per round of a blog cleanup, and the time kept back to hand the rest to the next invocation
+DELETE_PAGE_SIZE = 1000
+TIME_RESERVE_MS = 5000
+# Subscribers read per page of a fan-out, and the threads writing their timelines
+FANOUT_PAGE_SIZE = 1000
+FANOUT_WORKERS = 4
+# Content objects younger than this may belong to a post update that hasn't been written yet
+CONTENT_GRACE = timedelta(minutes=5)
+# Threads writing a document's search postings
+INDEX_WORKERS = 4
+
+
+# The event source mapping has ReportBatchItemFailures on, so only the messages listed in
+# batchItemFailures come back to the queue and the rest of the batch is done with.
+@metrics.handler('sqs_processor')
 def lambda_handler(event, context):
-    for message in event['Records']:
-        process_message(message)
-        s3_message = {
-            "message": "Notification processed successfully!",
-            "messageBody": message,
-            "timestamp": datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-        }
-        post_log_to_s3(s3_message)
+    failures = []
+    processed = []
+    try:
+        for message in event['Records']:
+            try:
+                process_message(message, context)
+            except Exception as err:
+                print("message failed:", message['messageId'], repr(err))
+                failures.append(message['messageId'])
+            else:
+                processed.append(message)
 
-    print("done")
+        if processed:
+            try:
+                archive_batch(processed)
+            except Exception as err:
+                # without an archive the messages are retried, processing them again is harmless
+                print("archive failed:", repr(err))
+                failures.extend(message['messageId'] for message in processed)
+    finally:
+        publisher.flush()
 
+    metrics.add("Messages", len(event['Records']))
+    metrics.add("FailedMessages", len(failures))
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]}
 
-def post_log_to_s3(log_message):
-    log_file_name = f'log-{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}.txt'
+
+# Writes the batch as one object, a JSON line per message, in the hour partition of the time the batch
+# was handled. The compactor later merges each hour into Parquet.
+def archive_batch(messages, now=None):
+    now = now or datetime.now(timezone.utc)
+    lines = [json.dumps(archive_record(message, now)) for message in messages]
+    key = object_key(RAW_PREFIX, now, "jsonl.gz")
     s3_client.put_object(
         Bucket=bucket_name,
-        Key=log_file_name,
-        Body=json.dumps(log_message)  # Convert the dictionary to a JSON string
+        Key=key,
+        Body=gzip.compress("\n".join(lines).encode() + b"\n"),
+        ContentType="application/x-ndjson",
+        ContentEncoding="gzip"
     )
+    return key
+
+
+def archive_record(message, now):
+    body = parse_body(message['body'])
+    record = {
+        "message_id": message['messageId'],
+        "sent_at": int(message.get('attributes', {}).get('SentTimestamp', 0)),
+        "archived_at": now.isoformat(),
+        "event_type": body.get("event_type")
+    }
+    # events are stored as objects, anything else is kept as the text it arrived as
+    if body:
+        record["event"] = body
+    else:
+        record["body"] = message['body']
+    return record
+
+
+def process_message(message, context):
+    body = parse_body(message['body'])
+    for handler in EVENT_HANDLERS.get(body.get("event_type"), ()):
+        handler(body, context)
+
 
+# Not every message is JSON, anything else is only logged
+def parse_body(raw_body):
+    try:
+        body = json.loads(raw_body)
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+# Deletes a blog's posts, then its subscriptions, then the blog itself, a page at a time. Every round
+# reads what is left again, so a redelivered or restarted request just carries on where the last one
+# stopped. When time runs short the request goes back on the queue for the next invocation.
+def continue_blog_deletion(request, context):
+    blog_id = request["blog_id"]
+    for table, next_keys in ((blog_post_table, blog_post_keys), (blog_subscription_table, blog_subscription_keys)):
+        while True:
+            if time_left_ms(context) < TIME_RESERVE_MS:
+                # the same envelope goes back, so consumers see one request however many rounds it takes.
+                # If it can't be sent this message fails and is redelivered instead.
+                publisher.requeue(request)
+                return False
+            keys = next_keys(table, blog_id, DELETE_PAGE_SIZE)
+            if not keys:
+                break
+            # the posts' search documents and the subscribers' timelines go first, nothing finds them
+            # once the keys are gone
+            if table is blog_post_table:
+                remove_posts_from_index([key["Id"] for key in keys])
+            else:
+                remove_blog_from_timelines(blog_id, [key["user_id"] for key in keys])
+            deleted = delete_keys(table, keys)
+            if table is blog_post_table:
+                record_progress(blog_id, deleted)
 
-def process_message(message):
     try:
-        print(f'here is the message in the body: {message['body']}')
-    except Exception as err:
-        print("An error occurrred")
-        raise err
\ No newline at end of file
+        blog_blog_table.delete_item(Key={"Id": blog_id}, ConditionExpression=Attr("deletion_status").exists())
+    except blog_blog_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return True
+    publisher.publish(events.BLOG_DELETED, blog_id, request.get("author_id"))
+    return True
+
+
+# posts_deleted on the blog item shows the cleanup's progress, it can run slightly ahead of the real
+# number since the index may still list posts that were just deleted
+def record_progress(blog_id, deleted):
+    try:
+        blog_blog_table.update_item(
+            Key={"Id": blog_id},
+            UpdateExpression="ADD posts_deleted :deleted",
+            ConditionExpression=Attr("Id").exists(),
+            ExpressionAttributeValues={":deleted": deleted}
+        )
+    except blog_blog_table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+
+
+# What a deleted user leaves behind: their blogs are marked and handed to the blog cleanup one
+# blog.delete_requested each, then their subscriptions and timeline are deleted a page at a time.
+# Every round reads what is left again, so like a blog cleanup the event is requeued when time runs short.
+def clean_up_user(event, context):
+    user_id = event["author_id"]
+    for blog_id in user_blog_ids(user_id):
+        try:
+            blog_blog_table.update_item(Key={"Id": blog_id}, ConditionExpression=Attr("author").eq(user_id),
+                                        **deletion_update())
+        except blog_blog_table.meta.client.exceptions.ConditionalCheckFailedException:
+            continue
+        publisher.publish(events.BLOG_DELETE_REQUESTED, blog_id, user_id)
+
+    for table, next_keys in ((blog_subscription_table, user_subscription_keys), (blog_timeline_table, user_timeline_keys)):
+        while True:
+            if time_left_ms(context) < TIME_RESERVE_MS:
+                publisher.requeue(event)
+                return False
+            keys = next_keys(user_id)
+            if not keys:
+                break
+            if table is blog_subscription_table:
+                remove_subscriptions(keys)
+            else:
+                delete_keys(table, keys)
+    return True
+
+
+# The user's blogs that aren't being deleted yet
+def user_blog_ids(user_id):
+    kwargs = {"IndexName": LOOKUP_INDEXES["author"], "KeyConditionExpression": Key("author").eq(user_id),
+              "ProjectionExpression": "Id, deletion_status"}
+    while True:
+        page = blog_blog_table.query(**kwargs)
+        yield from (blog["Id"] for blog in page["Items"] if "deletion_status" not in blog)
+        if "LastEvaluatedKey" not in page:
+            return
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+
+def user_subscription_keys(user_id):
+    page = blog_subscription_table.query(Limit=DELETE_PAGE_SIZE, **subscriptions_query(user_id))
+    return [{"blog_id": item["blog_id"], "user_id": item["user_id"]} for item in page["Items"]]
+
+
+def user_timeline_keys(user_id):
+    page = blog_timeline_table.query(KeyConditionExpression=Key("user_id").eq(user_id),
+                                     ProjectionExpression="user_id, entry_key", Limit=DELETE_PAGE_SIZE)
+    return page["Items"]
+
+
+# Unsubscribes so the blogs' subscriber counts go down too. Subscriptions to blogs that are already
+# gone can't be counted down and are simply deleted.
+def remove_subscriptions(keys):
+    def remove(key):
+        if unsubscribe(blog_subscription_table, blog_blog_table, key["blog_id"], key["user_id"]) is None:
+            blog_subscription_table.delete_item(Key=key)
+    with ThreadPoolExecutor(max_workers=FANOUT_WORKERS) as pool:
+        list(pool.map(metrics.bind(remove), keys))
+
+
+def time_left_ms(context):
+    if context is None:
+        return float("inf")
+    return context.get_remaining_time_in_millis()
+
+
+# Copies a new post into the timeline of every subscriber of its blog. Blogs with more than
+# FANOUT_LIMIT subscribers are switched to fan-out-on-read instead and never copied.
+def fan_out_post(event, context):
+    blog = get_fanout_blog(event["blog_id"])
+    if blog is None:
+        return
+    if blog.get("fanout_mode") == FANOUT_READ:
+        return
+    if blog.get("subscriber_count", 0) > FANOUT_LIMIT:
+        switch_to_fanout_on_read(event["blog_id"])
+        return
+
+    data = event.get("data") or {}
+    for user_ids in subscriber_pages(event["blog_id"]):
+        write_timelines([{"PutRequest": {"Item": timeline_entry(
+            user_id, event["post_id"], event["blog_id"], event["author_id"], data.get("title"), data["created_at"]
+        )}} for user_id in user_ids])
+
+
+def remove_post_from_timelines(event, context):
+    blog = get_fanout_blog(event["blog_id"])
+    created_at = (event.get("data") or {}).get("created_at")
+    if blog is None or blog.get("fanout_mode") == FANOUT_READ or created_at is None:
+        return
+    key = entry_key(created_at, event["post_id"])
+    for user_ids in subscriber_pages(event["blog_id"]):
+        write_timelines([{"DeleteRequest": {"Key": {"user_id": user_id, "entry_key": key}}} for user_id in user_ids])
+
+
+# A new subscriber gets the blog's latest posts in their timeline, or the blog added to their pull
+# item if it is read at feed time
+def add_subscription_to_timeline(event, context):
+    user_id = event["data"]["user_id"]
+    blog = get_fanout_blog(event["blog_id"])
+    if blog is None:
+        return
+    if blog.get("fanout_mode") == FANOUT_READ:
+        add_pull_blog(blog_timeline_table.meta.client, user_id, event["blog_id"])
+        return
+    posts = blog_post_table.query(Limit=BACKFILL_POSTS, **blog_posts_query(event["blog_id"]))["Items"]
+    write_timelines([{"PutRequest": {"Item": timeline_entry(
+        user_id, post["Id"], post["blog_id"], post.get("author_id"), post.get("title"), post["created_at"]
+    )}} for post in posts])
+
+
+def remove_subscription_from_timeline(event, context):
+    remove_blog_from_timeline(event["data"]["user_id"], event["blog_id"])
+
+
+def remove_blog_from_timelines(blog_id, user_ids):
+    with ThreadPoolExecutor(max_workers=FANOUT_WORKERS) as pool:
+        list(pool.map(metrics.bind(lambda user_id: remove_blog_from_timeline(user_id, blog_id)), user_ids))
+
+
+def remove_blog_from_timeline(user_id, blog_id):
+    try:
+        blog_timeline_table.update_item(
+            Key={"user_id": user_id, "entry_key": PULL_KEY},
+            UpdateExpression="DELETE blog_ids :blog",
+            ConditionExpression=Attr("user_id").exists(),
+            ExpressionAttributeValues={":blog": {blog_id}}
+        )
+    except blog_timeline_table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+
+    # the blog's posts already in the timeline go too, they are found by reading the whole timeline
+    kwargs = {"KeyConditionExpression": Key("user_id").eq(user_id), "FilterExpression": Attr("blog_id").eq(blog_id),
+              "ProjectionExpression": "user_id, entry_key"}
+    while True:
+        page = blog_timeline_table.query(**kwargs)
+        write_timelines([{"DeleteRequest": {"Key": item}} for item in page["Items"]])
+        if "LastEvaluatedKey" not in page:
+            return
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+
+# The blog's subscriber count and fan-out mode, None once it is gone or being deleted
+def get_fanout_blog(blog_id):
+    blog = blog_blog_table.get_item(
+        Key={"Id": blog_id}, ProjectionExpression="subscriber_count, fanout_mode, deletion_status"
+    ).get("Item")
+    if blog is None or "deletion_status" in blog:
+        return None
+    return blog
+
+
+# Every subscriber gets the blog in their pull item before the blog is marked, so a run that stops
+# halfway is simply repeated by the next post
+def switch_to_fanout_on_read(blog_id):
+    client = blog_timeline_table.meta.client
+    with ThreadPoolExecutor(max_workers=FANOUT_WORKERS) as pool:
+        for user_ids in subscriber_pages(blog_id):
+            list(pool.map(metrics.bind(lambda user_id: add_pull_blog(client, user_id, blog_id)), user_ids))
+    blog_blog_table.update_item(
+        Key={"Id": blog_id},
+        UpdateExpression="SET fanout_mode = :read",
+        ConditionExpression=Attr("Id").exists(),
+        ExpressionAttributeValues={":read": FANOUT_READ}
+    )
+
+
+# Uses the table's client, resources aren't safe to share between threads
+def add_pull_blog(client, user_id, blog_id):
+    client.update_item(
+        TableName=blog_timeline_table.name,
+        Key={"user_id": user_id, "entry_key": PULL_KEY},
+        UpdateExpression="ADD blog_ids :blog",
+        ExpressionAttributeValues={":blog": {blog_id}}
+    )
+
+
+def subscriber_pages(blog_id):
+    kwargs = dict(subscribers_query(blog_id), ProjectionExpression="user_id", Limit=FANOUT_PAGE_SIZE)
+    while True:
+        page = blog_subscription_table.query(**kwargs)
+        if page["Items"]:
+            yield [item["user_id"] for item in page["Items"]]
+        if "LastEvaluatedKey" not in page:
+            return
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+
+# Writes that still fail after batch_write's retries fail the message, so SQS delivers it again;
+# the puts and deletes are safe to repeat
+def write_timelines(requests):
+    failed = batch_write(blog_timeline_table, requests, workers=FANOUT_WORKERS)
+    if failed:
+        raise RuntimeError(f"{len(failed)} timeline writes failed")
+
+
+# Deletes the S3 content objects a post no longer points at, all of them once the post is gone.
+# Recent objects of a live post are left for the cleanup after its next content change.
+def clean_post_content(event, context):
+    if event["event_type"] == events.POST_UPDATED and "content" not in (event.get("data") or {}).get("fields", []):
+        return
+    post = blog_post_table.get_item(
+        Key={"Id": event["post_id"]}, ConsistentRead=True, ProjectionExpression="Id, content_key"
+    ).get("Item")
+    if post is None:
+        delete_content(content_prefix(event["blog_id"], event["post_id"]))
+    else:
+        delete_content(content_prefix(event["blog_id"], event["post_id"]), keep=post.get("content_key"),
+                       before=datetime.now(timezone.utc) - CONTENT_GRACE)
+
+
+# Whatever content the blog's posts offloaded, once the blog is deleted
+def clean_blog_content(event, context):
+    delete_content(content_prefix(event["blog_id"]))
+
+
+def delete_content(prefix, keep=None, before=None):
+    stale = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        stale.extend(entry["Key"] for entry in page.get("Contents", [])
+                     if entry["Key"] != keep and (before is None or entry["LastModified"] < before))
+    for start in range(0, len(stale), 1000):
+        s3_client.delete_objects(Bucket=bucket_name, Delete={
+            "Objects": [{"Key": key} for key in stale[start:start + 1000]], "Quiet": True
+        })
+
+
+# The search index follows the item as it is when the event is handled, not what the event says, so
+# events arriving late, twice or out of order all leave it matching the table
+def index_post(event, context):
+    post = blog_post_table.get_item(
+        Key={"Id": event["post_id"]}, ConsistentRead=True, ProjectionExpression="Id, title, content, content_key, version"
+    ).get("Item")
+    if post is None:
+        remove_document(blog_search_table, POST, event["post_id"], INDEX_WORKERS)
+        return
+    content = read_content(s3_client, bucket_name, post) if "content_key" in post else post.get("content")
+    index_document(blog_search_table, POST, post["Id"], post.get("title"), content, post.get("version", 0), INDEX_WORKERS)
+
+
+# The posts a blog deletion removed go without events of their own. The queue processor's cleanup
+# removes each page from the index itself, the one in DELETE /blog lists them on blog.deleted.
+def remove_posts_from_index(post_ids):
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as pool:
+        list(pool.map(metrics.bind(lambda post_id: remove_document(blog_search_table, POST, post_id)), post_ids))
+
+
+def remove_deleted_posts_from_index(event, context):
+    remove_posts_from_index((event.get("data") or {}).get("post_ids") or [])
+
+
+# Blogs being deleted leave the index straight away
+def index_blog(event, context):
+    blog = blog_blog_table.get_item(
+        Key={"Id": event["blog_id"]}, ConsistentRead=True,
+        ProjectionExpression="Id, title, category, description, version, deletion_status"
+    ).get("Item")
+    if blog is None or "deletion_status" in blog:
+        remove_document(blog_search_table, BLOG, event["blog_id"], INDEX_WORKERS)
+        return
+    body = " ".join(blog.get(name) or "" for name in ("category", "description"))
+    index_document(blog_search_table, BLOG, blog["Id"], blog.get("title"), body, blog.get("version", 0), INDEX_WORKERS)
+
+
+EVENT_HANDLERS = {
+    events.BLOG_CREATED: (index_blog,),
+    events.BLOG_UPDATED: (index_blog,),
+    events.BLOG_DELETE_REQUESTED: (index_blog, continue_blog_deletion),
+    events.BLOG_DELETED: (index_blog, clean_blog_content, remove_deleted_posts_from_index),
+    events.POST_CREATED: (fan_out_post, index_post),
+    events.POST_UPDATED: (clean_post_content, index_post),
+    events.POST_DELETED: (remove_post_from_timelines, clean_post_content, index_post),
+    events.SUBSCRIPTION_CREATED: (add_subscription_to_timeline,),
+    events.SUBSCRIPTION_DELETED: (remove_subscription_from_timeline,),
+    events.USER_DELETED: (clean_up_user,),
+}
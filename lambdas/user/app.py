@@ -1,16 +1,31 @@
-import base64
-import boto3
 from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.conditions import Attr
 from os import getenv
 from uuid import uuid4
-import json
+from common import aws, events, metrics
+from common.items import cancellation_codes, condition_failure, parse_version, transaction_update, versioned_update
+from common.pagination import get_page_params, paginate
+from common.responses import request_body, response
+from common.users import claim_username, get_current_user_id, get_users_by_username, release_username
 
-region_name = getenv('APP_REGION')
-blog_user_table = boto3.resource('dynamodb', region_name=region_name).Table('BlogUser')
+queue_url = getenv('QUEUE_URL')
+publisher = events.EventPublisher(queue_url)
 
+blog_user_table = aws.table('BlogUser')
+blog_username_table = aws.table('BlogUsername')
 
+CONDITION_FAILED = "ConditionalCheckFailed"
+
+
+@metrics.handler('user')
 def lambda_handler(event, context):
+    try:
+        return handle_request(event, context)
+    finally:
+        publisher.flush()
+
+
+def handle_request(event, context):
     # print("Received event:", event)
     http_method = event["httpMethod"]
     # print(http_method)
@@ -18,20 +33,11 @@ def lambda_handler(event, context):
     if http_method == "POST" or http_method == "post":
         return create_user(event, context)
 
-    # grab the auth header and decode it
-    auth_header = event["headers"]["Authorization"]
-    if not auth_header:
-        return response(401, "Unauthorized")
-    encoded_credentials = auth_header.split(' ')[1]
-    decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-
-    # Get the user's guid from the decoded credentials
-    current_user_id = get_user_by_username_password(decoded_credentials.split(":")[0], decoded_credentials.split(":")[1])
-    # print("Received event: " + json.dumps(event, indent=2))
-    # current_user_id = event['requestContext']['authorizer']['user_id']
+    # Get the user's guid from the authorizer context, or from their credentials if it isn't there
+    current_user_id = get_current_user_id(event, blog_user_table)
     # We only need to check the remaining http methods if the user is authenticated, we can do that here once.
-    # if current_user_id is None:
-    #     return response(401, "Unauthorized")
+    if current_user_id is None:
+        return response(401, "Unauthorized")
 
     if http_method == "GET":
         return get_user(event, context)
@@ -48,45 +54,41 @@ def lambda_handler(event, context):
 # Anyone can create a user, no need for authentication
 def create_user(event, context):
     if "body" in event and event["body"] is not None:
-        event = json.loads(event["body"])
-
-    # Check if username already exists in the table
-    user = blog_user_table.scan(FilterExpression=Attr('username').eq(event["username"]))
-    if len(user["Items"]) > 0:
-        return response(400, {"error": "Username already exists"})
+        event = request_body(event)
 
     # Generate a new guid for the user
     user_id = str(uuid4())
     # Grab the username and password from the request body
-    username = event["username"]
-    password = event["password"]
+    username = event.get("username")
+    password = event.get("password")
 
     # check if the username or password is empty
     if username is None or password is None:
         return response(400, {"error": "Username and password are required"})
+    error = invalid_credentials({"username": username, "password": password})
+    if error:
+        return response(400, {"error": error})
 
-    # Check if the username is already taken???
-    blog_user_table.put_item(Item={
-        "Id": user_id,
-        "username": username,
-        "password": password
-    })
+    # The user and the claim on their username are written together. If the name is already claimed
+    # neither is, however many signups for it arrive at once.
+    client = blog_user_table.meta.client
+    try:
+        client.transact_write_items(TransactItems=[
+            claim_username(blog_username_table, username, user_id),
+            {"Put": {
+                "TableName": blog_user_table.name,
+                "Item": {"Id": user_id, "username": username, "password": password, "version": 1},
+                "ConditionExpression": "attribute_not_exists(Id)"
+            }}
+        ])
+    except client.exceptions.TransactionCanceledException as err:
+        if cancellation_codes(err)[0] == CONDITION_FAILED:
+            return response(400, {"error": "Username already exists"})
+        raise
 
     return response(200, {"user_id": user_id, "message": "User successfully created!"})
 
 
-# Grabs the current users guid with their auth credentials
-def get_user_by_username_password(username, password):
-    # find the user in the table
-    user = blog_user_table.scan(FilterExpression=Attr('username').eq(username) & Attr('password').eq(password))
-    # if the user is found, return their guid
-    if len(user["Items"]) == 1:
-        return user["Items"][0]["Id"]
-    # if the user is not found, return None
-    else:
-        return None
-
-
 # This endpoint is only accessible by users of the website, returns the user's username and id.
 def get_user(event, context):
     path = event.get("pathParameters") or {}
@@ -111,11 +113,11 @@ def get_user(event, context):
     elif "username" in path:
         username = path["username"]
         # Fetch the user data from the table. Make sure to handle potential exceptions here.
-        user_data = blog_user_table.scan(FilterExpression=Attr("username").eq(username))
+        users = get_users_by_username(blog_user_table, username)
         # Check if the user was found
-        if len(user_data["Items"]) == 0:
+        if len(users) == 0:
             return response(404, {"error": f"User with username {username} not found"})
-        user = user_data["Items"][0]
+        user = users[0]
         # Construct a response that only includes the user_id and username
         user_info = {
             "user_id": user["Id"],
@@ -123,44 +125,134 @@ def get_user(event, context):
         }
         return response(200, user_info)
 
-    # If no path parameters are provided, return a list of all users
-    users = blog_user_table.scan()["Items"]
+    # If no path parameters are provided, return a page of users. Only the id and username are read,
+    # so passwords never leave the table.
+    try:
+        limit, start_key = get_page_params(event, ["Id"])
+    except ValueError as err:
+        return response(400, {"error": str(err)})
+    users, next_cursor = paginate(blog_user_table.scan, ["Id"], limit, start_key,
+                                  ProjectionExpression="#id, #username",
+                                  ExpressionAttributeNames={"#id": "Id", "#username": "username"})
     simplified_users = [{"username": user.get("username"), "Id": user.get("Id")} for user in users]
-    return response(200, simplified_users)
+    return response(200, {"items": simplified_users, "next_cursor": next_cursor})
 
 
 #   Only the user can update their own account, we grab their guid by get_user_by_username_password(username, password):
 def update_user(event, context, user_id):
     if "body" in event and event["body"] is not None:
-        event = json.loads(event["body"])
+        event = request_body(event)
 
-    username = event["username"]
-    password = event["password"]
+    try:
+        expected_version = parse_version(event.get("expected_version"))
+    except ValueError as err:
+        return response(400, {"error": str(err)})
 
-    user = blog_user_table.get_item(Key={"Id": user_id})["Item"]
+    # one update of just the supplied fields. Bumping the version stamp also makes warm authorizers
+    # drop their cached credentials for this user.
+    changes = {name: event[name] for name in ("username", "password") if event.get(name) is not None}
+    error = invalid_credentials(changes)
+    if error:
+        return response(400, {"error": error})
+    client = blog_user_table.meta.client
+    try:
+        old_username = current_username(user_id) if "username" in changes else None
+        if "username" in changes and old_username != changes["username"]:
+            user = rename_user(user_id, old_username, changes, expected_version)
+        else:
+            user = blog_user_table.update_item(
+                Key={"Id": user_id},
+                **versioned_update(changes, Attr("Id").exists(), expected_version)
+            )["Attributes"]
+    except LookupError:
+        return response(404, "Not found")
+    except client.exceptions.ConditionalCheckFailedException as err:
+        return response(*condition_failure(err, "Id", user_id))
+    except client.exceptions.TransactionCanceledException as err:
+        codes = cancellation_codes(err)
+        if codes[1] == CONDITION_FAILED:
+            return response(400, {"error": "Username already exists"})
+        if codes[0] == CONDITION_FAILED:
+            return response(*condition_failure(err, "Id", user_id, 0))
+        # the old name's claim was released or taken over by someone else in the meantime
+        if len(codes) > 2 and codes[2] == CONDITION_FAILED:
+            return response(409, {"error": "Username changed, try again"})
+        raise
 
-    if username is not None:
-        user['username'] = username
-    if password is not None:
-        user['password'] = password
+    user.pop("password", None)
+    return response(200, user)
 
-    blog_user_table.put_item(Item=user)
 
-    return response(200, user)
+# Why a username or password in `fields` can't be stored, or None. Usernames are key attributes of
+# the claim table and the username index, and neither can be empty.
+def invalid_credentials(fields):
+    for name, value in fields.items():
+        if not isinstance(value, str) or value == "":
+            return f"{name.capitalize()} must be a non-empty string"
+    return None
+
 
+# The new name is claimed, the user updated and the old name released in one transaction, so a
+# rename either happens completely or not at all. The update also checks the username it replaces,
+# in case another rename got in between.
+def rename_user(user_id, old_username, changes, expected_version):
+    update = versioned_update(changes, Attr("Id").exists() & Attr("username").eq(old_username), expected_version)
+    blog_user_table.meta.client.transact_write_items(TransactItems=[
+        transaction_update(blog_user_table, {"Id": user_id}, update),
+        claim_username(blog_username_table, changes["username"], user_id)
+    ] + release_claim(old_username, user_id))
+    # transactions return nothing, the updated user is read back
+    return blog_user_table.get_item(Key={"Id": user_id}, ConsistentRead=True)["Item"]
 
-# Only the user can delete their own account, we grab their guid by get_user_by_username_password(username, password):
+
+# Only the user can delete their own account. The user and their username claim go at once, their
+# blogs, subscriptions and timeline are deleted by the queue processor on user.deleted.
 def delete_user(user_id):
-    output = blog_user_table.delete_item(Key={"Id": user_id})
-    return response(200, output)
-
-
-def response(code, body):
-    return {
-        "statusCode": code,
-        "headers": {
-            "Content-Type": "application/json"
-        },
-        "body": json.dumps(body),
-        "isBase64Encoded": False
-    }
+    try:
+        username = current_username(user_id)
+    except LookupError:
+        return response(404, "Not found")
+
+    client = blog_user_table.meta.client
+    try:
+        client.transact_write_items(TransactItems=[
+            {"Delete": {
+                "TableName": blog_user_table.name,
+                "Key": {"Id": user_id},
+                "ConditionExpression": "username = :username",
+                "ExpressionAttributeValues": {":username": username},
+                "ReturnValuesOnConditionCheckFailure": "ALL_OLD"
+            }}
+        ] + release_claim(username, user_id))
+    except client.exceptions.TransactionCanceledException as err:
+        codes = cancellation_codes(err)
+        # renamed or deleted in the meantime
+        if codes[0] == CONDITION_FAILED:
+            return response(*condition_failure(err, "Id", user_id, 0))
+        if CONDITION_FAILED in codes:
+            return response(409, {"error": "Username changed, try again"})
+        raise
+
+    publisher.publish(events.USER_DELETED, None, user_id, username=username)
+    return response(202, {"user_id": user_id, "status": "deleting"})
+
+
+# The user's username, read consistently. Raises LookupError if the user doesn't exist.
+def current_username(user_id):
+    user = blog_user_table.get_item(
+        Key={"Id": user_id},
+        ProjectionExpression="username",
+        ConsistentRead=True
+    ).get("Item")
+    if user is None:
+        raise LookupError(user_id)
+    return user.get("username")
+
+
+# The write releasing the user's claim on `username`, if they hold it. Users created before claims
+# existed may have none, or share their name with the user who does.
+def release_claim(username, user_id):
+    claim = blog_username_table.get_item(Key={"username": username}, ConsistentRead=True).get("Item")
+    if claim is None or claim.get("user_id") != user_id:
+        return []
+    return [release_username(blog_username_table, username, user_id)]
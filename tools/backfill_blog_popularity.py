@@ -0,0 +1,68 @@
+"""Backfill subscriber_count and popularity_shard on existing BlogBlog items.
+
+Blogs created before the popularity index have neither attribute, so they are
+missing from `GET /blog` until this has run once after deploying:
+
+    python tools/backfill_blog_popularity.py --region us-west-2
+
+Safe to re-run and to run while the API is live: the count is only written if
+the subscriber list still has the size it was computed from.
+"""
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambdas'))
+
+from common.blogs import popularity_shard  # noqa: E402
+
+
+def legacy_blogs(table):
+    kwargs = {
+        'FilterExpression': Attr('subscriber_count').not_exists() | Attr('popularity_shard').not_exists(),
+        'ProjectionExpression': 'Id',
+    }
+    while True:
+        page = table.scan(**kwargs)
+        yield from page['Items']
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def backfill(table, blog_id):
+    while True:
+        blog = table.get_item(Key={'Id': blog_id}, ConsistentRead=True).get('Item')
+        if blog is None:
+            return False
+        count = len(blog.get('subscribers', []))
+        try:
+            table.update_item(
+                Key={'Id': blog_id},
+                UpdateExpression='SET subscriber_count = :count, popularity_shard = :shard',
+                ConditionExpression='size(subscribers) = :count OR attribute_not_exists(subscribers)',
+                ExpressionAttributeValues={':count': count, ':shard': popularity_shard(blog_id)},
+            )
+            return True
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            # someone subscribed in between, count again
+            continue
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--table', default='BlogBlog')
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    args = parser.parse_args()
+
+    table = boto3.resource('dynamodb', region_name=args.region, endpoint_url=args.endpoint_url).Table(args.table)
+    updated = sum(backfill(table, blog['Id']) for blog in legacy_blogs(table))
+    print(f"Backfilled {updated} blog(s)")
+
+
+if __name__ == '__main__':
+    main()
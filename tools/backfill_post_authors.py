@@ -0,0 +1,65 @@
+"""Copy each blog's author onto its BlogPost items as author_id.
+
+Edits and deletes check ownership against the post's own author_id, so posts
+written before it was stored can't be changed until this has run:
+
+    python tools/backfill_post_authors.py --region us-west-2
+
+Safe to re-run, posts that already have an author_id are never touched.
+Posts whose blog no longer exists are reported and left alone.
+"""
+import argparse
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+
+def posts_without_author(table):
+    kwargs = {'FilterExpression': Attr('author_id').not_exists(), 'ProjectionExpression': 'Id, blog_id'}
+    while True:
+        page = table.scan(**kwargs)
+        yield from page['Items']
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource('dynamodb', region_name=args.region, endpoint_url=args.endpoint_url)
+    post_table = dynamodb.Table('BlogPost')
+    blog_table = dynamodb.Table('BlogBlog')
+
+    authors = {}
+    updated = 0
+    orphaned = []
+    for post in posts_without_author(post_table):
+        blog_id = post.get('blog_id')
+        if blog_id not in authors:
+            blog = blog_table.get_item(Key={'Id': blog_id}).get('Item') if blog_id else None
+            authors[blog_id] = blog['author'] if blog else None
+        if authors[blog_id] is None:
+            orphaned.append(post['Id'])
+            continue
+        try:
+            post_table.update_item(
+                Key={'Id': post['Id']},
+                UpdateExpression='SET author_id = :author',
+                ConditionExpression='attribute_exists(Id) AND attribute_not_exists(author_id)',
+                ExpressionAttributeValues={':author': authors[blog_id]},
+            )
+            updated += 1
+        except post_table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    print(f"Backfilled {updated} post(s)")
+    if orphaned:
+        print(f"{len(orphaned)} post(s) belong to missing blogs: {', '.join(orphaned)}")
+
+
+if __name__ == '__main__':
+    main()
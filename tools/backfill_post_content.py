@@ -0,0 +1,69 @@
+"""Give BlogPost items written before content offloading an excerpt and hash.
+
+Listings only return excerpts, so older posts show up without one until this
+has run. Content over the inline limit is moved to S3 on the way:
+
+    python tools/backfill_post_content.py --region us-west-2 --bucket <bucket>
+
+Safe to re-run, posts that already have an excerpt are never touched.
+"""
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambdas'))
+
+from common.content import stale_content_attributes, store_content  # noqa: E402
+
+
+def posts_without_excerpt(table):
+    kwargs = {'FilterExpression': Attr('excerpt').not_exists() & Attr('content').exists(),
+              'ProjectionExpression': 'Id, blog_id, content'}
+    while True:
+        page = table.scan(**kwargs)
+        yield from page['Items']
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    parser.add_argument('--s3-endpoint-url')
+    args = parser.parse_args()
+
+    table = boto3.resource('dynamodb', region_name=args.region, endpoint_url=args.endpoint_url).Table('BlogPost')
+    s3 = boto3.client('s3', region_name=args.region, endpoint_url=args.s3_endpoint_url)
+
+    updated = 0
+    offloaded = 0
+    for post in posts_without_excerpt(table):
+        fields = store_content(s3, args.bucket, post['blog_id'], post['Id'], post['content'])
+        removals = stale_content_attributes(fields)
+        expression = 'SET ' + ', '.join(f'#{name} = :{name}' for name in fields)
+        if removals:
+            expression += ' REMOVE ' + ', '.join(f'#{name}' for name in removals)
+        try:
+            table.update_item(
+                Key={'Id': post['Id']},
+                UpdateExpression=expression,
+                ConditionExpression=Attr('Id').exists() & Attr('excerpt').not_exists(),
+                ExpressionAttributeNames={f'#{name}': name for name in list(fields) + removals},
+                ExpressionAttributeValues={f':{name}': value for name, value in fields.items()},
+            )
+            updated += 1
+            offloaded += 'content_key' in fields
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    print(f"Backfilled {updated} post(s), {offloaded} moved to S3")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Give BlogPost items written before created_at existed a timestamp.
+
+Posts without created_at are left out of blog-created-index and so never show
+up in /blog/posts/{blog_id}. Their real creation time is unknown; by default
+they get the Unix epoch so they sort after every post created since:
+
+    python tools/backfill_post_timestamps.py --region us-west-2 [--created-at 2024-01-01T00:00:00Z]
+
+Safe to re-run, posts that already have a created_at are never touched.
+"""
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambdas'))
+
+from common.items import parse_timestamp  # noqa: E402
+
+
+def untimestamped_posts(table):
+    kwargs = {'FilterExpression': Attr('created_at').not_exists(), 'ProjectionExpression': 'Id'}
+    while True:
+        page = table.scan(**kwargs)
+        yield from page['Items']
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--created-at', default='1970-01-01T00:00:00Z')
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    args = parser.parse_args()
+
+    created_at = parse_timestamp(args.created_at)
+    table = boto3.resource('dynamodb', region_name=args.region, endpoint_url=args.endpoint_url).Table('BlogPost')
+    updated = 0
+    for post in untimestamped_posts(table):
+        try:
+            table.update_item(
+                Key={'Id': post['Id']},
+                UpdateExpression='SET created_at = :created_at',
+                ConditionExpression='attribute_exists(Id) AND attribute_not_exists(created_at)',
+                ExpressionAttributeValues={':created_at': created_at},
+            )
+            updated += 1
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+    print(f"Backfilled {updated} post(s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Index the posts and blogs written before GET /search existed.
+
+The queue processor keeps BlogSearch up to date from post and blog events,
+anything older is only found once this has run:
+
+    python tools/build_search_index.py --region us-west-2 --bucket <bucket>
+
+Safe to re-run, documents whose version is already indexed are skipped.
+"""
+import argparse
+import os
+import sys
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambdas'))
+
+from common.content import read_content  # noqa: E402
+from common.search import BLOG, POST, index_document  # noqa: E402
+
+
+def scan(table, projection):
+    kwargs = {'ProjectionExpression': projection}
+    while True:
+        page = table.scan(**kwargs)
+        yield from page['Items']
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    parser.add_argument('--s3-endpoint-url')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource('dynamodb', region_name=args.region, endpoint_url=args.endpoint_url)
+    search_table = dynamodb.Table('BlogSearch')
+    s3 = boto3.client('s3', region_name=args.region, endpoint_url=args.s3_endpoint_url)
+
+    indexed = {POST: 0, BLOG: 0}
+    for blog in scan(dynamodb.Table('BlogBlog'), 'Id, title, category, description, version, deletion_status'):
+        if 'deletion_status' in blog:
+            continue
+        body = ' '.join(blog.get(name) or '' for name in ('category', 'description'))
+        indexed[BLOG] += index_document(search_table, BLOG, blog['Id'], blog.get('title'), body,
+                                        blog.get('version', 0), args.workers)
+    for post in scan(dynamodb.Table('BlogPost'), 'Id, title, content, content_key, version'):
+        content = read_content(s3, args.bucket, post) if 'content_key' in post else post.get('content')
+        indexed[POST] += index_document(search_table, POST, post['Id'], post.get('title'), content,
+                                        post.get('version', 0), args.workers)
+
+    print(f"Indexed {indexed[POST]} post(s) and {indexed[BLOG]} blog(s)")
+
+
+if __name__ == '__main__':
+    main()
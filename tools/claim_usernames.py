@@ -0,0 +1,60 @@
+"""Claim the usernames of users created before BlogUsername existed.
+
+Signups and renames only check the claims, so run this once after deploying
+the username table:
+
+    python tools/claim_usernames.py --region us-west-2
+
+Every user without a claim gets one. When several users already share a name
+the first one seen keeps it and the others are listed, they can still sign in
+but nobody can take the name from the one who holds the claim. Safe to re-run.
+"""
+import argparse
+import os
+import sys
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambdas'))
+
+from common.users import claim_username  # noqa: E402
+
+
+def users(user_table):
+    kwargs = {'ProjectionExpression': 'Id, username'}
+    while True:
+        page = user_table.scan(**kwargs)
+        yield from page['Items']
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource('dynamodb', region_name=args.region, endpoint_url=args.endpoint_url)
+    user_table = dynamodb.Table('BlogUser')
+    username_table = dynamodb.Table('BlogUsername')
+    client = username_table.meta.client
+
+    claimed = 0
+    for user in users(user_table):
+        if user.get('username') is None:
+            continue
+        try:
+            client.put_item(**claim_username(username_table, user['username'], user['Id'])['Put'])
+            claimed += 1
+        except client.exceptions.ConditionalCheckFailedException:
+            holder = username_table.get_item(Key={'username': user['username']}, ConsistentRead=True)['Item']
+            if holder['user_id'] != user['Id']:
+                print(f"{user['username']!r} is claimed by {holder['user_id']}, user {user['Id']} shares it")
+
+    print(f"Claimed {claimed} username(s)")
+
+
+if __name__ == '__main__':
+    main()
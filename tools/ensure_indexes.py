@@ -0,0 +1,121 @@
+"""Create the global secondary indexes declared in template.yaml, one at a time.
+
+Only for tables the stack doesn't manage, such as DynamoDB Local or tables
+created by hand:
+
+    python tools/ensure_indexes.py --endpoint-url http://localhost:8000 [--table BlogBlog]
+
+Never run it against the stack's own tables. CloudFormation compares against
+the previous template, so the next `sam deploy` would try to create the same
+indexes again and the update would fail. Those tables get their indexes from
+deploys, one new index per table each time (see the note on BlogTable in
+template.yaml).
+
+DynamoDB backfills each new index from the existing items. The lambdas fall
+back to a paginated scan for the username lookup until its index is ACTIVE.
+Items without an index's key attributes are not indexed; for username-index
+those users are listed at the end, since they could never log in.
+"""
+import argparse
+import os
+import time
+
+import boto3
+import yaml
+from boto3.dynamodb.conditions import Attr
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'template.yaml')
+
+
+class _TemplateLoader(yaml.SafeLoader):
+    pass
+
+
+_TemplateLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+
+
+def declared_tables():
+    with open(TEMPLATE) as template:
+        resources = yaml.load(template, Loader=_TemplateLoader)['Resources']
+    return {resource['Properties']['TableName']: resource['Properties']
+            for resource in resources.values() if resource['Type'] == 'AWS::DynamoDB::Table'}
+
+
+def create_index(client, table_name, declared, index):
+    description = client.describe_table(TableName=table_name)['Table']
+    key_names = {key['AttributeName'] for key in index['KeySchema']}
+    create = {
+        'IndexName': index['IndexName'],
+        'KeySchema': index['KeySchema'],
+        'Projection': index['Projection'],
+    }
+    if description.get('BillingModeSummary', {}).get('BillingMode') != 'PAY_PER_REQUEST':
+        throughput = description['ProvisionedThroughput']
+        create['ProvisionedThroughput'] = {
+            'ReadCapacityUnits': throughput['ReadCapacityUnits'],
+            'WriteCapacityUnits': throughput['WriteCapacityUnits'],
+        }
+    client.update_table(
+        TableName=table_name,
+        AttributeDefinitions=[definition for definition in declared['AttributeDefinitions']
+                              if definition['AttributeName'] in key_names],
+        GlobalSecondaryIndexUpdates=[{'Create': create}],
+    )
+
+
+def wait_until_active(client, table_name, index_name, poll_seconds):
+    while True:
+        description = client.describe_table(TableName=table_name)['Table']
+        index = next(i for i in description.get('GlobalSecondaryIndexes', []) if i['IndexName'] == index_name)
+        status = index['IndexStatus']
+        backfilling = index.get('Backfilling', False)
+        print(f"{table_name}.{index_name}: status={status} backfilling={backfilling} "
+              f"indexed={index.get('ItemCount', 0)}/{description.get('ItemCount', 0)} (approximate)")
+        if status == 'ACTIVE' and not backfilling:
+            return
+        time.sleep(poll_seconds)
+
+
+def users_without_username(table):
+    kwargs = {'FilterExpression': Attr('username').not_exists(), 'ProjectionExpression': 'Id'}
+    while True:
+        page = table.scan(**kwargs)
+        for item in page['Items']:
+            yield item['Id']
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--table', action='append', help='only these tables (default: all in the template)')
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    parser.add_argument('--poll-seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    session = boto3.session.Session(region_name=args.region)
+    client = session.client('dynamodb', endpoint_url=args.endpoint_url)
+
+    for table_name, declared in declared_tables().items():
+        if args.table and table_name not in args.table:
+            continue
+        existing = {index['IndexName'] for index in
+                    client.describe_table(TableName=table_name)['Table'].get('GlobalSecondaryIndexes', [])}
+        for index in declared.get('GlobalSecondaryIndexes', []):
+            if index['IndexName'] not in existing:
+                print(f"Creating {table_name}.{index['IndexName']}")
+                create_index(client, table_name, declared, index)
+            wait_until_active(client, table_name, index['IndexName'], args.poll_seconds)
+
+    if not args.table or 'BlogUser' in args.table:
+        table = session.resource('dynamodb', endpoint_url=args.endpoint_url).Table('BlogUser')
+        missing = list(users_without_username(table))
+        if missing:
+            print(f"{len(missing)} user(s) have no username and are not indexed: {', '.join(missing)}")
+    print("Done")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Move the legacy `subscribers` lists out of BlogBlog into BlogSubscription.
+
+Run once after deploying the subscription table:
+
+    python tools/migrate_subscriptions.py --region us-west-2
+
+Each blog's list is written as (blog_id, user_id) items, then the blog's
+subscriber_count is set from the subscription table (so subscriptions made
+through the new API in the meantime are counted) and the list is removed.
+Re-running skips blogs that were already migrated.
+"""
+import argparse
+import os
+import sys
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambdas'))
+
+from common.blogs import popularity_shard  # noqa: E402
+from common.subscriptions import subscribers_query  # noqa: E402
+
+
+def legacy_blogs(blog_table):
+    kwargs = {
+        'FilterExpression': Attr('subscribers').exists(),
+        'ProjectionExpression': 'Id, subscribers',
+    }
+    while True:
+        page = blog_table.scan(**kwargs)
+        yield from page['Items']
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def count_subscribers(subscription_table, blog_id):
+    kwargs = dict(subscribers_query(blog_id), Select='COUNT')
+    count = 0
+    while True:
+        page = subscription_table.query(**kwargs)
+        count += page['Count']
+        if 'LastEvaluatedKey' not in page:
+            return count
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def migrate(blog_table, subscription_table, blog):
+    blog_id = blog['Id']
+    with subscription_table.batch_writer(overwrite_by_pkeys=['blog_id', 'user_id']) as batch:
+        for user_id in set(blog['subscribers']):
+            batch.put_item(Item={'blog_id': blog_id, 'user_id': user_id})
+
+    blog_table.update_item(
+        Key={'Id': blog_id},
+        UpdateExpression='SET subscriber_count = :count, popularity_shard = :shard REMOVE subscribers',
+        ExpressionAttributeValues={
+            ':count': count_subscribers(subscription_table, blog_id),
+            ':shard': popularity_shard(blog_id),
+        },
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource('dynamodb', region_name=args.region, endpoint_url=args.endpoint_url)
+    blog_table = dynamodb.Table('BlogBlog')
+    subscription_table = dynamodb.Table('BlogSubscription')
+
+    migrated = 0
+    for blog in legacy_blogs(blog_table):
+        migrate(blog_table, subscription_table, blog)
+        migrated += 1
+    print(f"Migrated {migrated} blog(s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Query the compacted event archive in S3 by time range, event type and blog.
+
+Only the hour partitions inside the time range are listed, and from each Parquet
+file only the footer and the row groups whose statistics can match are fetched,
+with ranged GETs:
+
+    python tools/query_events.py --bucket <bucket> --start 2024-05-01T00:00 \\
+        --end 2024-05-02T00:00 --event-type post.created --blog-id <blog guid>
+
+Partitions are by archive time and rows by occurred_at, so the hours after the
+range are read as well, for events archived late (--archive-lag-hours, 1 by
+default). Rows are printed as JSON lines, the read statistics go to stderr. --include-raw
+also reads the hours that haven't been compacted yet. Point --endpoint-url at a
+local S3 stand-in (moto server, MinIO) to try it without AWS.
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas'))
+
+from common.archive import COMPACTED_PREFIX, RAW_PREFIX, S3RangeReader, arrow_schema, hours_between, parse_time
+from common.archive import partition_hour, read_raw, to_row
+
+# How long after it occurred an event may still be archived: SQS redeliveries, retried batches and
+# requeued deletions that keep their original occurred_at
+ARCHIVE_LAG = timedelta(hours=1)
+
+
+class QueryStats:
+    def __init__(self):
+        self.files = 0
+        self.row_groups = 0
+        self.row_groups_skipped = 0
+        self.requests = 0
+        self.bytes_read = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def list_objects(s3, bucket, prefix):
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get('Contents', [])
+
+
+# Objects under `prefix` whose hour partition overlaps [start, end + archive_lag], listed one day at a time
+def objects_in_range(s3, bucket, prefix, start, end, stats, archive_lag=ARCHIVE_LAG):
+    last = end + archive_lag
+    for day in sorted({hour.date() for hour in hours_between(start, last + timedelta(hours=1))}):
+        stats.requests += 1
+        for entry in list_objects(s3, bucket, f'{prefix}/dt={day:%Y-%m-%d}/'):
+            hour = partition_hour(entry['Key'])
+            if hour is not None and start - timedelta(hours=1) < hour <= last:
+                yield entry
+
+
+# Could a row group whose column statistics are `stats` hold a row in `values`, or in [low, high)?
+def may_match(statistics, values=None, low=None, high=None):
+    if statistics is None or not statistics.has_min_max:
+        return True
+    if values is not None:
+        return any(statistics.min <= value <= statistics.max for value in values)
+    return (high is None or statistics.min < high) and (low is None or statistics.max >= low)
+
+
+def row_filter(start, end, event_types, blog_id):
+    condition = (pc.field('occurred_at') >= pa.scalar(start, pa.timestamp('us', tz='UTC'))) & \
+                (pc.field('occurred_at') < pa.scalar(end, pa.timestamp('us', tz='UTC')))
+    if event_types:
+        condition = condition & pc.field('event_type').isin(event_types)
+    if blog_id is not None:
+        condition = condition & (pc.field('blog_id') == blog_id)
+    return condition
+
+
+def read_compacted(s3, bucket, entry, start, end, event_types, blog_id, columns, stats):
+    reader = S3RangeReader(s3, bucket, entry['Key'], size=entry['Size'])
+    parquet = pq.ParquetFile(reader)
+    names = parquet.schema_arrow.names
+    selected = []
+    for index in range(parquet.num_row_groups):
+        group = parquet.metadata.row_group(index)
+        statistics = {names[column]: group.column(column).statistics for column in range(group.num_columns)}
+        if may_match(statistics['occurred_at'], low=start, high=end) and \
+                (not event_types or may_match(statistics['event_type'], values=event_types)) and \
+                (blog_id is None or may_match(statistics['blog_id'], values=[blog_id])):
+            selected.append(index)
+    stats.files += 1
+    stats.row_groups += parquet.num_row_groups
+    stats.row_groups_skipped += parquet.num_row_groups - len(selected)
+    table = parquet.read_row_groups(selected, columns=columns) if selected else arrow_schema().empty_table()
+    stats.requests += reader.requests
+    stats.bytes_read += reader.bytes_read
+    return table
+
+
+def read_raw_object(s3, bucket, entry, stats):
+    stats.files += 1
+    stats.requests += 1
+    stats.bytes_read += entry['Size']
+    payload = s3.get_object(Bucket=bucket, Key=entry['Key'])['Body'].read()
+    return pa.Table.from_pylist([to_row(record) for record in read_raw(payload)], schema=arrow_schema())
+
+
+# Returns the matching rows as a pyarrow Table, sorted by occurred_at, and the QueryStats of the reads
+def query_events(s3, bucket, start, end, event_types=None, blog_id=None, include_raw=False,
+                 archive_lag=ARCHIVE_LAG):
+    stats = QueryStats()
+    columns = arrow_schema().names
+    tables = [
+        read_compacted(s3, bucket, entry, start, end, event_types, blog_id, columns, stats)
+        for entry in objects_in_range(s3, bucket, COMPACTED_PREFIX, start, end, stats, archive_lag)
+    ]
+    if include_raw:
+        tables.extend(read_raw_object(s3, bucket, entry, stats)
+                      for entry in objects_in_range(s3, bucket, RAW_PREFIX, start, end, stats, archive_lag))
+
+    table = pa.concat_tables([table.select(columns) for table in tables]) if tables else arrow_schema().empty_table()
+    table = table.filter(row_filter(start, end, event_types, blog_id))
+    # a message compacted while the raw objects were being listed could show up twice
+    if include_raw and table.num_rows:
+        first = pc.equal(pc.index_in(table['message_id'], table['message_id']), pa.array(range(table.num_rows)))
+        table = table.filter(first)
+    return table.sort_by('occurred_at'), stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--start', required=True, help='ISO 8601, UTC unless an offset is given')
+    parser.add_argument('--end', help='ISO 8601, exclusive, defaults to now')
+    parser.add_argument('--event-type', action='append', dest='event_types', help='may be given more than once')
+    parser.add_argument('--blog-id')
+    parser.add_argument('--include-raw', action='store_true', help='also read hours not compacted yet')
+    parser.add_argument('--archive-lag-hours', type=float, default=ARCHIVE_LAG / timedelta(hours=1),
+                        help='also read this many hours after the range, for events archived late')
+    parser.add_argument('--region')
+    parser.add_argument('--endpoint-url', help='e.g. http://localhost:5000 for a moto server')
+    args = parser.parse_args()
+
+    s3 = boto3.client('s3', region_name=args.region, endpoint_url=args.endpoint_url)
+    start = parse_time(args.start)
+    end = parse_time(args.end) if args.end else datetime.now(timezone.utc)
+    table, stats = query_events(s3, args.bucket, start, end, args.event_types, args.blog_id, args.include_raw,
+                                timedelta(hours=args.archive_lag_hours))
+    for row in table.to_pylist():
+        print(json.dumps(row, default=str))
+    print(json.dumps(dict(stats.as_dict(), rows=table.num_rows)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""Export DynamoDB tables to gzipped JSON Lines shards and import them back.
+
+Backups, reindexing and migrations (a new attribute, a new GSI, a copy into a
+table with a different layout) start from a full copy of a table. Exports use
+a parallel segmented scan, each of --segments slices of the table is read by
+one of --workers threads and written as shards of about --shard-items items:
+
+    python tools/table_transfer.py export --region us-west-2 --output backup \\
+        --tables BlogUser BlogBlog BlogPost --segments 16 --workers 8
+    python tools/table_transfer.py import --region us-west-2 --input backup \\
+        --tables BlogPost --target BlogPost=BlogPostV2 --write-capacity 500
+
+Imports send the shards with parallel BatchWriteItem calls. --read-capacity and
+--write-capacity cap the capacity units spent per second, the rate is halved
+whenever DynamoDB throttles and grows back towards the cap while it doesn't.
+
+Both directions are resumable: an export records how far each segment got and
+an import which shards are written, so re-running the same command after a
+failure carries on where it stopped. Items are kept in DynamoDB's own JSON
+format, so numbers, sets and binary values come back exactly. A segmented scan
+is not a snapshot, items written during the export may or may not be in it.
+
+Works against DynamoDB Local with --endpoint-url http://localhost:8000.
+"""
+import argparse
+import base64
+import glob
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import boto3
+from botocore.config import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambdas'))
+
+from common.batch import BATCH_WRITE_SIZE, MAX_ATTEMPTS, backoff  # noqa: E402
+
+TABLES = ('BlogUser', 'BlogUsername', 'BlogBlog', 'BlogPost', 'BlogSubscription', 'BlogTimeline', 'BlogSearch')
+SHARD_SUFFIX = '.jsonl.gz'
+MANIFEST = 'manifest.json'
+
+
+class RateLimiter:
+    # Capacity units per second shared by every worker of a table, as a token bucket charged with
+    # what each call reports it consumed. A throttled call halves the rate, each second without one
+    # adds back a tenth of the target. No target means no limit.
+    def __init__(self, target):
+        self.target = target
+        self.rate = target
+        self.tokens = target or 0
+        self.updated = time.monotonic()
+        self.throttled_at = 0.0
+        self.lock = threading.Lock()
+
+    # Blocks until the bucket isn't overdrawn any more
+    def wait(self):
+        if not self.target:
+            return
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens > 0:
+                    return
+                delay = -self.tokens / self.rate
+            time.sleep(min(delay, 1.0))
+
+    def spend(self, units):
+        if self.target:
+            with self.lock:
+                self.tokens -= units
+
+    def throttled(self):
+        if self.target:
+            with self.lock:
+                self.rate = max(self.target / 20, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+                self.throttled_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        if now - self.throttled_at > 1:
+            self.rate = min(self.target, self.rate + self.target / 10 * elapsed)
+        self.tokens = min(self.rate, self.tokens + self.rate * elapsed)
+
+
+# Binary values are the only ones JSON can't hold as they are
+def encode_value(value):
+    (kind, data), = value.items()
+    if kind == 'B':
+        return {'B': base64.b64encode(data).decode('ascii')}
+    if kind == 'BS':
+        return {'BS': [base64.b64encode(entry).decode('ascii') for entry in data]}
+    if kind == 'L':
+        return {'L': [encode_value(entry) for entry in data]}
+    if kind == 'M':
+        return {'M': encode_item(data)}
+    return value
+
+
+def decode_value(value):
+    (kind, data), = value.items()
+    if kind == 'B':
+        return {'B': base64.b64decode(data)}
+    if kind == 'BS':
+        return {'BS': [base64.b64decode(entry) for entry in data]}
+    if kind == 'L':
+        return {'L': [decode_value(entry) for entry in data]}
+    if kind == 'M':
+        return {'M': decode_item(data)}
+    return value
+
+
+def encode_item(item):
+    return {name: encode_value(value) for name, value in item.items()}
+
+
+def decode_item(item):
+    return {name: decode_value(value) for name, value in item.items()}
+
+
+def consumed_units(result):
+    consumed = result.get('ConsumedCapacity') or []
+    return sum(float(entry.get('CapacityUnits', 0)) for entry in (consumed if isinstance(consumed, list) else [consumed]))
+
+
+# Writes `path` whole or not at all, readers never see half a file
+def write_atomically(path, data):
+    with open(path + '.tmp', 'wb') as output:
+        output.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path) as source:
+        return json.load(source)
+
+
+def shard_path(table_dir, segment, shard):
+    return os.path.join(table_dir, f'{segment:05d}-{shard:05d}{SHARD_SUFFIX}')
+
+
+# Scans one segment into shards. After every shard the segment's checkpoint records the scan
+# position, a restarted export starts from there and rewrites at most the shard it was on.
+def export_segment(client, table_name, table_dir, segment, segments, limiter, shard_items):
+    checkpoint_path = os.path.join(table_dir, 'checkpoints', f'{segment:05d}.json')
+    state = read_json(checkpoint_path, {'next_shard': 0, 'last_key': None, 'items': 0, 'done': False})
+    if state['done']:
+        return state['items']
+
+    kwargs = {'TableName': table_name, 'Segment': segment, 'TotalSegments': segments, 'ReturnConsumedCapacity': 'TOTAL'}
+    if state['last_key']:
+        kwargs['ExclusiveStartKey'] = decode_item(state['last_key'])
+    lines = []
+    while True:
+        limiter.wait()
+        page = client.scan(**kwargs)
+        limiter.spend(consumed_units(page))
+        if page['ResponseMetadata'].get('RetryAttempts'):
+            limiter.throttled()
+        lines.extend(json.dumps(encode_item(item), separators=(',', ':')) for item in page['Items'])
+        last_key = page.get('LastEvaluatedKey')
+        if len(lines) >= shard_items or last_key is None:
+            if lines:
+                write_atomically(shard_path(table_dir, segment, state['next_shard']),
+                                 gzip.compress(('\n'.join(lines) + '\n').encode('utf-8')))
+                state['next_shard'] += 1
+                state['items'] += len(lines)
+                lines = []
+            state.update(last_key=encode_item(last_key) if last_key else None, done=last_key is None)
+            write_atomically(checkpoint_path, json.dumps(state).encode('utf-8'))
+        if last_key is None:
+            return state['items']
+        kwargs['ExclusiveStartKey'] = last_key
+
+
+# Exports `table_name` into `directory`/`table_name`/ and returns the number of items written. The
+# manifest is written last, so its presence marks a complete export.
+def export_table(client, table_name, directory, segments=16, workers=8, read_capacity=None, shard_items=10000):
+    table_dir = os.path.join(directory, table_name)
+    manifest_path = os.path.join(table_dir, MANIFEST)
+    manifest = read_json(manifest_path)
+    if manifest is not None:
+        return manifest['items']
+
+    os.makedirs(os.path.join(table_dir, 'checkpoints'), exist_ok=True)
+    started_path = os.path.join(table_dir, 'export.json')
+    started = read_json(started_path)
+    if started is None:
+        write_atomically(started_path, json.dumps({'segments': segments}).encode('utf-8'))
+    elif started['segments'] != segments:
+        raise SystemExit(f'{table_name}: the export in {table_dir} was started with --segments {started["segments"]}, '
+                         f'resume it with the same count or export into a new directory')
+
+    description = client.describe_table(TableName=table_name)['Table']
+    limiter = RateLimiter(read_capacity)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        counts = list(pool.map(lambda segment: export_segment(client, table_name, table_dir, segment, segments,
+                                                              limiter, shard_items), range(segments)))
+
+    manifest = {
+        'table': table_name,
+        'items': sum(counts),
+        'segments': segments,
+        'shards': sorted(os.path.basename(path) for path in glob.glob(os.path.join(table_dir, '*' + SHARD_SUFFIX))),
+        'key_schema': description['KeySchema'],
+        'attribute_definitions': description['AttributeDefinitions'],
+        'exported_at': datetime.now(timezone.utc).isoformat(),
+    }
+    write_atomically(manifest_path, json.dumps(manifest, indent=2).encode('utf-8'))
+    return manifest['items']
+
+
+# Writes one shard with BatchWriteItem, retrying unprocessed items. Raises if some are still left
+# after the retries, the shard is then not checkpointed and the next run writes it again.
+def import_shard(client, table_name, path, limiter):
+    with gzip.open(path, 'rt', encoding='utf-8') as source:
+        items = [decode_item(json.loads(line)) for line in source if line.strip()]
+    for start in range(0, len(items), BATCH_WRITE_SIZE):
+        request = {table_name: [{'PutRequest': {'Item': item}} for item in items[start:start + BATCH_WRITE_SIZE]]}
+        for attempt in range(MAX_ATTEMPTS):
+            limiter.wait()
+            result = client.batch_write_item(RequestItems=request, ReturnConsumedCapacity='TOTAL')
+            limiter.spend(consumed_units(result))
+            request = result.get('UnprocessedItems') or {}
+            if not request:
+                break
+            limiter.throttled()
+            backoff(attempt)
+        if request:
+            raise RuntimeError(f'{len(request[table_name])} item(s) of {os.path.basename(path)} still unprocessed')
+    return len(items)
+
+
+# Imports the export of `table_name` in `directory` into `target` (the same table by default).
+# Returns (items written, shards that failed). Finished shards are appended to a log next to the
+# export, one per target table, and skipped when the import is run again.
+def import_table(client, table_name, directory, target=None, workers=8, write_capacity=None):
+    target = target or table_name
+    table_dir = os.path.join(directory, table_name)
+    manifest = read_json(os.path.join(table_dir, MANIFEST))
+    if manifest is None:
+        raise SystemExit(f'{table_name}: no complete export in {table_dir}')
+
+    log_path = os.path.join(table_dir, f'imported-{target}.log')
+    done = set()
+    if os.path.exists(log_path):
+        with open(log_path) as log:
+            done = {line.strip() for line in log if line.strip()}
+    pending = [name for name in manifest['shards'] if name not in done]
+
+    limiter = RateLimiter(write_capacity)
+    written = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool, open(log_path, 'a') as log:
+        futures = {pool.submit(import_shard, client, target, os.path.join(table_dir, name), limiter): name
+                   for name in pending}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                written += future.result()
+            except Exception as err:
+                print(f'{table_name}: {name} failed: {err!r}')
+                failed.append(name)
+                continue
+            log.write(name + '\n')
+            log.flush()
+    return written, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export')
+    export.add_argument('--output', required=True, help='directory the shards are written to')
+    export.add_argument('--segments', type=int, default=16)
+    export.add_argument('--read-capacity', type=float, help='read units per second to stay under, per table')
+    export.add_argument('--shard-items', type=int, default=10000)
+    load = commands.add_parser('import')
+    load.add_argument('--input', required=True, help='directory of a previous export')
+    load.add_argument('--target', action='append', default=[], metavar='SOURCE=TARGET',
+                      help='import the export of SOURCE into the table TARGET')
+    load.add_argument('--write-capacity', type=float, help='write units per second to stay under, per table')
+    for command in (export, load):
+        command.add_argument('--tables', nargs='+', default=TABLES)
+        command.add_argument('--workers', type=int, default=8)
+        command.add_argument('--region')
+        command.add_argument('--endpoint-url', help='e.g. http://localhost:8000 for DynamoDB Local')
+    args = parser.parse_args()
+
+    # a connection per worker, and botocore's own retries only as a first line against throttling
+    client = boto3.client('dynamodb', region_name=args.region, endpoint_url=args.endpoint_url, config=Config(
+        max_pool_connections=args.workers, retries={'mode': 'standard', 'max_attempts': 3}))
+
+    failed = False
+    for table_name in args.tables:
+        start = time.perf_counter()
+        if args.command == 'export':
+            items = export_table(client, table_name, args.output, args.segments, args.workers, args.read_capacity,
+                                 args.shard_items)
+            print(f'{table_name}: exported {items} item(s) in {time.perf_counter() - start:.1f}s')
+        else:
+            targets = dict(entry.split('=', 1) for entry in args.target)
+            items, failed_shards = import_table(client, table_name, args.input, targets.get(table_name), args.workers,
+                                                args.write_capacity)
+            print(f'{table_name}: imported {items} item(s) in {time.perf_counter() - start:.1f}s')
+            failed = failed or bool(failed_shards)
+    if failed:
+        raise SystemExit('some shards failed, run the import again to retry them')
+
+
+if __name__ == '__main__':
+    main()